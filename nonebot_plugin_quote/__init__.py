@@ -10,8 +10,7 @@ import random
 import os
 import shutil
 import asyncio
-from .prep import plugin_config, need_at, quote_path, ocr, emulating_font_path, record_dict, inverted_index, forward_index, save_json
-from .task import offer, query, delete, findAlltag, addTag, delTag
+from .prep import plugin_config, need_at, quote_path, ocr_pool, emulating_font_path, quote_service
 from .task import copy_images_files
 from .config import Config, check_font
 from nonebot.log import logger
@@ -43,10 +42,6 @@ async def save_img_handle(bot: Bot, event: GroupMessageEvent, state: T_State, Se
 
     message_id = event.message_id
     user_id = Session.id1
-
-    global inverted_index
-    global record_dict
-    global forward_index
     
     if event.reply:
         raw_message = str(event.reply.message)
@@ -82,33 +77,15 @@ async def save_img_handle(bot: Bot, event: GroupMessageEvent, state: T_State, Se
     image_path = os.path.abspath(os.path.join(quote_path, os.path.basename(image_path)))
     image_name = os.path.basename(image_path)
     logger.info(f"图片已保存到 {image_path}")
-    loop = asyncio.get_running_loop()
-    ocr_result = await loop.run_in_executor(None, ocr.predict, image_path)
-    ocr_result = ocr_result[0]['rec_texts']
-    try:
-        ocr_result.remove('')
-    except:
-        pass
-    ocr_result = list(set(ocr_result))
-    ocr_content = ''
-    try:
-        for line in ocr_result:
-            ocr_content += f"{line} "
-    except Exception as e:
-        ocr_content = ''
-        logger.error(f"OCR识别失败: {e}")
+    if not ocr_pool.ready:
+        await save_img.send(MessageSegment.reply(message_id)+MessageSegment.text('OCR模型加载中，识别完成后自动保存'))
+    ocr_content = await ocr_pool.recognize_text(image_path)
+    if ocr_content is None:
+        await save_img.finish(MessageSegment.reply(message_id)+MessageSegment.text('OCR识别失败，未保存，请稍后重新上传'))
 
     group_id = Session.id2
 
-    inverted_index, forward_index = offer(group_id, image_name, ocr_content, inverted_index, forward_index)
-
-    if group_id not in list(record_dict.keys()):
-        record_dict[group_id] = [image_name]
-    else:
-        if image_name not in record_dict[group_id]:
-            record_dict[group_id].append(image_name)
-
-    save_json(record_dict, inverted_index)
+    await quote_service.offer(group_id, image_name, ocr_content)
 
     await save_img.finish(MessageSegment.reply(message_id)+MessageSegment.text('保存成功'))
 
@@ -119,11 +96,8 @@ async def record_pool_handle(bot: Bot, event: GroupMessageEvent, state: T_State,
 
     ats = False
 
-    global inverted_index
-    global record_dict
-
     search_info = str(event.get_message()).strip()
-    search_info = search_info.replace('{}语录'.format(plugin_config.quote_startcmd), '').replace(' ', '')
+    search_info = search_info.replace('{}语录'.format(plugin_config.quote_startcmd), '').strip()
 
     group_id = Session.id2
 
@@ -133,44 +107,41 @@ async def record_pool_handle(bot: Bot, event: GroupMessageEvent, state: T_State,
             break
 
     if ats:
-        try:
-            target_ats_list = []
-            for i in record_dict[group_id]:
-                if i.startswith(f"{ats}_"):
-                    target_ats_list.append(i)
-            length = len(target_ats_list)
-            idx = random.randint(0, length - 1)
-            msg = MessageSegment.image(file=os.path.abspath(os.path.join(quote_path, os.path.basename(target_ats_list[idx]))))
-        except:
-            length = len(record_dict[group_id])
-            idx = random.randint(0, length - 1)
-            msg = '当前查询无结果, 为您随机发送。'
-            msg_segment = MessageSegment.image(file=os.path.abspath(os.path.join(quote_path, os.path.basename(record_dict[group_id][idx]))))
-            msg = msg + msg_segment
+        name = await quote_service.random_pick(group_id, str(ats))
+        if name is not None:
+            msg = MessageSegment.image(file=os.path.abspath(os.path.join(quote_path, os.path.basename(name))))
+        else:
+            name = await quote_service.random_pick(group_id)
+            if name is None:
+                msg = '当前无语录库'
+            else:
+                msg = '当前查询无结果, 为您随机发送。'
+                msg_segment = MessageSegment.image(file=os.path.abspath(os.path.join(quote_path, os.path.basename(name))))
+                msg = msg + msg_segment
 
     elif search_info == '':
-        if group_id not in list(record_dict.keys()):
+        name = await quote_service.random_pick(group_id)
+        if name is None:
             msg = '当前无语录库'
         else:
-            length = len(record_dict[group_id])
-            idx = random.randint(0, length - 1)
-            msg = MessageSegment.image(file=os.path.abspath(os.path.join(quote_path, os.path.basename(record_dict[group_id][idx]))))
+            msg = MessageSegment.image(file=os.path.abspath(os.path.join(quote_path, os.path.basename(name))))
     else:
-        ret = query(search_info, group_id, inverted_index)
+        ret = await quote_service.query(search_info, group_id)
 
         if ret['status'] == -1:
             msg = '当前无语录库'
         elif ret['status'] == 2:
-            if group_id not in list(record_dict.keys()):
+            name = await quote_service.random_pick(group_id)
+            if name is None:
                 msg = '当前无语录库'
             else:
-                length = len(record_dict[group_id])
-                idx = random.randint(0, length - 1)
                 msg = '当前查询无结果, 为您随机发送。'
-                msg_segment = MessageSegment.image(file=os.path.abspath(os.path.join(quote_path, os.path.basename(record_dict[group_id][idx]))))
+                msg_segment = MessageSegment.image(file=os.path.abspath(os.path.join(quote_path, os.path.basename(name))))
                 msg = MessageSegment.text(msg) + msg_segment
         elif ret['status'] == 1:
             msg = MessageSegment.image(file=os.path.abspath(os.path.join(quote_path, os.path.basename(ret['msg']))))
+        elif ret['status'] == 3:
+            msg = '当前存储引擎不支持组合查询, 请去掉 | - 引号 括号等符号后重试'
         else:
             msg = ret.text
 
@@ -195,10 +166,6 @@ delete_record = on_regex(pattern=r'^{}删除$'.format(re.escape(plugin_config.qu
 @delete_record.handle()
 async def delete_record_handle(bot: Bot, event: Event, state: T_State, Session: EventSession):
 
-    global inverted_index
-    global record_dict
-    global forward_index
-
     user_id = str(event.get_user_id())
     
     group_id = Session.id2
@@ -210,10 +177,9 @@ async def delete_record_handle(bot: Bot, event: Event, state: T_State, Session:
     imgs = await reply_handle(bot, errMsg, event.model_dump(), group_id, user_id, delete_record)
     
     # 搜索
-    is_Delete, record_dict, inverted_index, forward_index = delete(imgs, group_id, record_dict, inverted_index, forward_index)
+    is_Delete = await quote_service.delete(imgs, group_id)
 
     if is_Delete:
-        save_json(record_dict, inverted_index)
         msg = '删除成功'
     else:
         msg = '该图不在语录库中'
@@ -226,17 +192,13 @@ alltag = on_command('{}alltag'.format(plugin_config.quote_startcmd), aliases={'{
 @alltag.handle()
 async def alltag_handle(bot: Bot, event: GroupMessageEvent, state: T_State, Session: EventSession):
 
-    global inverted_index
-    global record_dict
-    global forward_index
-
     user_id = str(event.get_user_id())
 
     group_id = Session.id2
 
     errMsg = '请回复需要指定语录'
     imgs = await reply_handle(bot, errMsg, event.model_dump(), group_id, user_id, alltag)  
-    tags = findAlltag(imgs, forward_index, group_id)
+    tags = await quote_service.find_tags(imgs, group_id)
     if tags is None:
         msg = '该语录不存在'
     elif tags == set():
@@ -255,9 +217,6 @@ addtag = on_regex(pattern="^{}addtag\ ".format(plugin_config.quote_startcmd), **
 @addtag.handle()
 async def addtag_handle(bot: Bot, event: GroupMessageEvent, state: T_State, Session: EventSession):
 
-    global inverted_index
-    global record_dict
-    global forward_index
     user_id = str(event.get_user_id())
     tags = str(event.get_message()).replace('{}addtag'.format(plugin_config.quote_startcmd), '').strip().split(' ')
 
@@ -266,8 +225,7 @@ async def addtag_handle(bot: Bot, event: GroupMessageEvent, state: T_State, Sess
     errMsg = '请回复需要指定语录'
     imgs = await reply_handle(bot, errMsg, event.model_dump(), group_id, user_id, addtag)
 
-    flag, forward_index, inverted_index = addTag(tags, imgs, group_id, forward_index, inverted_index)
-    save_json(record_dict, inverted_index)
+    flag = await quote_service.add_tags(tags, imgs, group_id)
 
     if flag is None:
         msg = '该语录不存在'
@@ -282,9 +240,6 @@ deltag = on_regex(pattern="^{}deltag\ ".format(plugin_config.quote_startcmd), **
 @deltag.handle()
 async def deltag_handle(bot: Bot, event: GroupMessageEvent, state: T_State, Session: EventSession):
 
-    global inverted_index
-    global record_dict
-    global forward_index
     user_id = str(event.get_user_id())
     tags = str(event.get_message()).replace('{}deltag'.format(plugin_config.quote_startcmd), '').strip().split(' ')
 
@@ -292,8 +247,7 @@ async def deltag_handle(bot: Bot, event: GroupMessageEvent, state: T_State, Sess
     errMsg = '请回复需要指定语录'
     imgs = await reply_handle(bot, errMsg, event.model_dump(), group_id, user_id, deltag)
 
-    flag, forward_index, inverted_index = delTag(tags, imgs, group_id, forward_index, inverted_index)
-    save_json(record_dict, inverted_index)
+    flag = await quote_service.del_tags(tags, imgs, group_id)
 
     if flag is None:
         msg = '该语录不存在'
@@ -302,6 +256,26 @@ async def deltag_handle(bot: Bot, event: GroupMessageEvent, state: T_State, Sess
     await deltag.finish(message=MessageSegment.text(msg), at_sender = True)
 
 
+tagcount = on_command('{}标签统计'.format(plugin_config.quote_startcmd), aliases={'{}tagcount'.format(plugin_config.quote_startcmd)}, **need_at)
+
+@tagcount.handle()
+async def tagcount_handle(bot: Bot, event: GroupMessageEvent, state: T_State, Session: EventSession):
+
+    group_id = Session.id2
+
+    counts = await quote_service.tag_counts(group_id)
+    if not counts:
+        msg = '本群还没有Tag，请使用addtag手动添加Tag'
+    else:
+        msg = '本群最常用的Tag为: '
+        n = 0
+        for tag, count in counts:
+            n += 1
+            msg += f'\n{n}. {tag} ({count}条)'
+
+    await tagcount.finish(MessageSegment.text(msg), at_sender = True)
+
+
 make_record = on_regex(pattern="^{}记录$".format(re.escape(plugin_config.quote_startcmd)))
 
 @make_record.handle()
@@ -314,10 +288,6 @@ async def make_record_handle(bot: Bot, event: GroupMessageEvent, state: T_State,
         logger.warning('未配置字体路径，部分功能无法使用')
         await make_record.finish()
 
-    global inverted_index
-    global record_dict
-    global forward_index
-
     if event.reply:
         size = 640
         qqid = event.reply.sender.user_id
@@ -331,38 +301,19 @@ async def make_record_handle(bot: Bot, event: GroupMessageEvent, state: T_State,
             if i["type"] == "image":
                 isimg = True
         img_data = await generate_emulating_native_qq_style_image(int(qqid), int(group_id), f"file:///{emulating_font_path}",  event.model_dump()['reply']['message'], bot)
-        image_name = f"{qqid}_{hashlib.md5(img_data).hexdigest()}.png"
+        digest = hashlib.md5(img_data).hexdigest()
+        image_name = f"{qqid}_{digest}.png"
         image_path = os.path.abspath(os.path.join(quote_path, os.path.basename(image_name)))
         with open(image_path, "wb") as file:
             file.write(img_data)
 
         if isimg:
-            loop = asyncio.get_running_loop()
-            ocr_result = await loop.run_in_executor(None, ocr.predict, image_path)
-            ocr_result = ocr_result[0]['rec_texts']
-            try:
-                ocr_result.remove('')
-            except:
-                pass
-            ocr_result = list(set(ocr_result))
-            ocr_content = ''
-            try:
-                for line in ocr_result:
-                    ocr_content += f"{line} "
-            except Exception as e:
-                ocr_content = ''
-                logger.error(f"OCR识别失败: {e}")
-            inverted_index, forward_index = offer(group_id, image_name, card + ' ' + ocr_content, inverted_index, forward_index)
-        else:
-            inverted_index, forward_index = offer(group_id, image_name, card + ' ' + raw_message, inverted_index, forward_index)
-
-        if group_id not in list(record_dict.keys()):
-            record_dict[group_id] = [image_name]
+            ocr_content = await ocr_pool.recognize_text(image_path, digest, rendered=True)
+            if ocr_content is None:
+                await make_record.finish(MessageSegment.image(img_data)+MessageSegment.text('OCR识别失败，未记录至语录库，请稍后重试'))
+            await quote_service.offer(group_id, image_name, card + ' ' + ocr_content)
         else:
-            if image_name not in record_dict[group_id]:
-                record_dict[group_id].append(image_name)
-
-        save_json(record_dict, inverted_index)
+            await quote_service.offer(group_id, image_name, card + ' ' + raw_message)
 
         msg = MessageSegment.image(img_data)
         await make_record.send(msg)
@@ -380,10 +331,6 @@ async def rumor_quote_hanle(bot: Bot, event: GroupMessageEvent, state: T_State,
     msglist = []
     multimessage = False
 
-    global inverted_index
-    global record_dict
-    global forward_index
-
     group_id = Session.id2
 
     for i in event.model_dump()['original_message']:
@@ -427,7 +374,8 @@ async def rumor_quote_hanle(bot: Bot, event: GroupMessageEvent, state: T_State,
         
         card = response['card_or_nickname']
 
-        image_name = f"{target_user_id}_{hashlib.md5(img_data).hexdigest()}.png"
+        digest = hashlib.md5(img_data).hexdigest()
+        image_name = f"{target_user_id}_{digest}.png"
 
         image_path = os.path.abspath(os.path.join(quote_path, os.path.basename(image_name)))
 
@@ -435,22 +383,10 @@ async def rumor_quote_hanle(bot: Bot, event: GroupMessageEvent, state: T_State,
             file.write(img_data)
 
         if isimg:
-            loop = asyncio.get_running_loop()
-            ocr_result = await loop.run_in_executor(None, ocr.predict, image_path)
-            ocr_result = ocr_result[0]['rec_texts']
-            try:
-                ocr_result.remove('')
-            except:
-                pass
-            ocr_result = list(set(ocr_result))
-            ocr_content = ''
-            try:
-                for line in ocr_result:
-                    ocr_content += f"{line} "
-            except Exception as e:
-                ocr_content = ''
-                logger.error(f"OCR识别失败: {e}")
-            inverted_index, forward_index = offer(group_id, image_name, card + ' ' + ocr_content, inverted_index, forward_index)
+            ocr_content = await ocr_pool.recognize_text(image_path, digest, rendered=True)
+            if ocr_content is None:
+                await rumor_quote.finish(MessageSegment.image(img_data)+MessageSegment.text('OCR识别失败，未记录至语录库，请稍后重试'))
+            await quote_service.offer(group_id, image_name, card + ' ' + ocr_content)
         else:
             msg_content = ''
             for i in msglist:
@@ -458,15 +394,7 @@ async def rumor_quote_hanle(bot: Bot, event: GroupMessageEvent, state: T_State,
                     msg_content = f'{i["data"]["text"]} '
                 except:
                     pass
-            inverted_index, forward_index = offer(group_id, image_name, card + ' ' + msg_content, inverted_index, forward_index)
-
-        if group_id not in list(record_dict.keys()):
-            record_dict[group_id] = [image_name]
-        else:
-            if image_name not in record_dict[group_id]:
-                record_dict[group_id].append(image_name)
-
-        save_json(record_dict, inverted_index)
+            await quote_service.offer(group_id, image_name, card + ' ' + msg_content)
 
         msg = MessageSegment.image(img_data)
         await make_record.finish(msg)
@@ -0,0 +1,39 @@
+import unicodedata
+
+
+# 统一的文本分析规则, 建索引和查询都经过这里
+# 规则有变化时增加版本号, 启动后旧索引会在后台按新规则重建; 停用词随索引一起保存, 配置改变时同样重建
+ANALYZER_VERSION = 1
+
+DEFAULT_STOPWORDS = ['.', ',', '!', '?', ':', ';', '。', '，', '！', '？', '：', '；', '%', '$', '[', ']']
+
+_stopwords = set(DEFAULT_STOPWORDS)
+
+
+def set_stopwords(words):
+    _stopwords.clear()
+    _stopwords.update(normalize(word) for word in words)
+
+
+# 当前停用词, 排序后用于与索引中保存的比较
+def stopword_list():
+    return sorted(_stopwords)
+
+
+# 全角/半角等兼容字符统一 (NFKC), 英文不区分大小写
+def normalize(text):
+    return unicodedata.normalize('NFKC', text).casefold()
+
+
+# 去掉空白、停用词与重复的词
+def filter_words(words):
+    return [word for word in dict.fromkeys(words) if word.strip() and word not in _stopwords]
+
+
+def normalize_tags(tags):
+    return [normalize(tag).strip() for tag in tags if tag.strip()]
+
+
+# 字二元组索引用的文本: 规范化后只保留文字和数字
+def normalize_text(text):
+    return ''.join(c for c in normalize(text) if c.isalnum())
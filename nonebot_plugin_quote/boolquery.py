@@ -0,0 +1,320 @@
+import re
+from collections import OrderedDict
+import unicodedata
+from .analyzer import normalize_text
+from .index import bigrams
+
+# 布尔查询: 空格/AND 为与, | 或 OR 为或, -词 或 NOT 为非, 括号分组, 引号内为原文子串, #开头为标签
+# 在每个群的整数位图 (int, 第 i 位表示文档 i) 上计算
+
+_TOKEN = re.compile(r'-?"[^"]*"?|-?“[^”]*”?|[()|]|[^\s()|"“]+')
+_KEYWORDS = {'AND', 'OR', 'NOT'}
+
+
+def tokenize(sentence):
+    # 全角符号转半角, 关键字保留大小写
+    return _TOKEN.findall(unicodedata.normalize('NFKC', sentence))
+
+
+def is_keyword(token):
+    return token in _KEYWORDS
+
+
+# 是否使用了布尔语法; 只有普通关键词时仍走原来的分词匹配
+def is_boolean(tokens):
+    for token in tokens:
+        if token in ('(', ')', '|') or token in _KEYWORDS:
+            return True
+        if token[0] in '"“' or (token[0] == '-' and len(token) > 1):
+            return True
+    return len(tokens) > 1 and any(token.startswith('#') for token in tokens)
+
+
+# 递归下降解析, 返回语法树: ('or', a, b) / ('and', a, b) / ('not', a) / ('word', s) / ('phrase', s) / ('tag', s)
+# 括号不配对时尽量按已有内容解析
+class _Parser:
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        node = self.parse_or()
+        while self.peek() is not None:
+            # 多余的右括号
+            self.next()
+            rest = self.parse_or()
+            if rest is not None:
+                node = rest if node is None else ('and', node, rest)
+        return node
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.peek() in ('|', 'OR'):
+            self.next()
+            rhs = self.parse_and()
+            if rhs is not None:
+                node = rhs if node is None else ('or', node, rhs)
+        return node
+
+    def parse_and(self):
+        node = None
+        while self.peek() not in (None, ')', '|', 'OR'):
+            if self.peek() == 'AND':
+                self.next()
+                continue
+            rhs = self.parse_unary()
+            if rhs is not None:
+                node = rhs if node is None else ('and', node, rhs)
+        return node
+
+    def parse_unary(self):
+        token = self.next()
+        if token == 'NOT':
+            operand = self.parse_unary() if self.peek() not in (None, ')', '|', 'OR') else None
+            return None if operand is None else ('not', operand)
+        if token == '(':
+            node = self.parse_or()
+            if self.peek() == ')':
+                self.next()
+            return node
+        if token[0] == '-' and len(token) > 1:
+            return ('not', self.atom(token[1:]))
+        return self.atom(token)
+
+    def atom(self, token):
+        if token[0] in '"“':
+            return ('phrase', token[1:].rstrip('"”'))
+        if token[0] == '#' and len(token) > 1:
+            return ('tag', token[1:])
+        return ('word', token)
+
+
+def parse(sentence):
+    return _Parser(tokenize(sentence)).parse()
+
+
+def to_bitset(arr):
+    if not arr:
+        return 0
+    bits = bytearray((arr[-1] >> 3) + 1)
+    for doc_id in arr:
+        bits[doc_id >> 3] |= 1 << (doc_id & 7)
+    return int.from_bytes(bits, 'little')
+
+
+# int.bit_count 需要 Python 3.10
+def popcount(bits):
+    return bin(bits).count('1')
+
+
+# 位图结果, 可直接用于 random.choice: len 为文档数, [k] 为第 k 个文档id
+class BitPool:
+
+    CHUNK = 1024    # 按块跳过, 块内逐字节查找
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.count = popcount(bits)
+        self._bytes = None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, k):
+        if not 0 <= k < self.count:
+            raise IndexError(k)
+        data = self._data()
+        base = 0
+        while True:
+            n = popcount(int.from_bytes(data[base:base + self.CHUNK], 'little'))
+            if k < n:
+                break
+            k -= n
+            base += self.CHUNK
+        for i in range(base, base + self.CHUNK):
+            n = _POPCOUNT[data[i]]
+            if k < n:
+                byte = data[i]
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        if k == 0:
+                            return i * 8 + bit
+                        k -= 1
+            k -= n
+
+    def _data(self):
+        if self._bytes is None:
+            self._bytes = to_bytes(self.bits)
+        return self._bytes
+
+    # 按字节取出为1的位, 不对整个大整数做逐位运算
+    def __iter__(self):
+        for match in _NONZERO.finditer(self._data()):
+            base = match.start() * 8
+            for bit in _BIT_POSITIONS[match.group()[0]]:
+                yield base + bit
+
+
+_POPCOUNT = [bin(i).count('1') for i in range(256)]
+_BIT_POSITIONS = [tuple(bit for bit in range(8) if i >> bit & 1) for i in range(256)]
+_NONZERO = re.compile(rb'[^\x00]')
+
+
+def to_bytes(bits):
+    return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+
+# 单个群的位图缓存 (LRU, 至多 maxsize 个)
+# 索引修改后按 GroupIndex.changes 只更新被改动文档的位, 改动太多时全部重建
+class Bitmaps:
+
+    def __init__(self, group, maxsize=128):
+        self.group = group
+        self.generation = group.generation
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+
+    def _sync(self):
+        group = self.group
+        if self.generation == group.generation:
+            return
+        changes = group.changes
+        if len(changes) == changes.maxlen and changes[0][0] > self.generation:
+            # 日志已不完整
+            self._cache.clear()
+        elif self._cache:
+            for doc_id in {doc_id for generation, doc_id in changes if generation > self.generation}:
+                grams = None
+                bit = 1 << doc_id
+                for key, bits in self._cache.items():
+                    kind = key[0]
+                    if kind == 'all':
+                        member = doc_id in group.records.pos
+                    elif kind == 'word':
+                        member = key[1] in group.terms.get(doc_id, ())
+                    elif kind == 'tag':
+                        member = key[1] in group.doc_tags.get(doc_id, ())
+                    else:
+                        if grams is None:
+                            grams = bigrams(group.grams.texts.get(doc_id, ''))
+                        member = key[1] in grams
+                    self._cache[key] = bits | bit if member else bits & ~bit
+        self.generation = group.generation
+
+    def get(self, key, arr):
+        self._sync()
+        bits = self._cache.get(key)
+        if bits is None:
+            bits = self._cache[key] = to_bitset(arr() if callable(arr) else arr)
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return bits
+
+    def universe(self):
+        return self.get(('all',), lambda: sorted(self.group.records.items))
+
+
+# analyze 为查询分词函数 (与普通查询相同的规则), 返回结果位图
+# 位图缓存挂在 GroupIndex 上, 随群索引一起释放
+def search(sentence, group, analyze):
+    node = parse(sentence)
+    if node is None:
+        return BitPool(0)
+    if group.bitmaps is None:
+        group.bitmaps = Bitmaps(group)
+    return BitPool(evaluate(node, group, group.bitmaps, analyze))
+
+
+# and 的各项按估计代价从小到大计算: 倒排表短的词在前, 需要核对原文的引号子串最后
+# 前面的结果作为范围传给后面的项, 子串只在已缩小的候选中核对
+def _cost(node, group, analyze):
+    kind = node[0]
+    if kind == 'word':
+        words = analyze(node[1])
+        return (0, min((len(group.postings.get(word, ())) for word in words), default=len(group.records)))
+    if kind == 'tag':
+        tag = analyze('#' + node[1])
+        return (0, len(group.tags.get(tag[0]) or group.postings.get(tag[0], ())) if tag else 0)
+    if kind == 'phrase':
+        return (2, 0)
+    return (1, 0)
+
+
+def _and_items(node, items):
+    if node[0] == 'and':
+        _and_items(node[1], items)
+        _and_items(node[2], items)
+    else:
+        items.append(node)
+    return items
+
+
+# mask 为结果的范围: 返回值只保证在 mask 内正确, 由调用方与 mask 求交
+def evaluate(node, group, bitmaps, analyze, mask=-1):
+    kind = node[0]
+    if kind == 'or':
+        return evaluate(node[1], group, bitmaps, analyze, mask) | evaluate(node[2], group, bitmaps, analyze, mask)
+    if kind == 'and':
+        items = sorted(_and_items(node, []), key=lambda item: _cost(item, group, analyze))
+        for item in items:
+            # 结果为空时不再计算后面的项
+            mask &= evaluate(item, group, bitmaps, analyze, mask)
+            if not mask:
+                return 0
+        return mask
+    if kind == 'not':
+        return bitmaps.universe() & ~evaluate(node[1], group, bitmaps, analyze, mask)
+    if kind == 'tag':
+        tag = analyze('#' + node[1])
+        if not tag:
+            return 0
+        if tag[0] in group.tags:
+            return bitmaps.get(('tag', tag[0]), group.tags[tag[0]])
+        # 旧版本混在分词中的标签
+        arr = group.postings.get(tag[0])
+        return bitmaps.get(('word', tag[0]), arr) if arr else 0
+    if kind == 'phrase':
+        text = normalize_text(node[1])
+        if len(text) < 2:
+            return evaluate(('word', node[1]), group, bitmaps, analyze, mask)
+        bits = mask
+        for gram in sorted(bigrams(text), key=lambda gram: len(group.grams.postings.get(gram, ()))):
+            arr = group.grams.postings.get(gram)
+            if not arr:
+                return 0
+            bits &= bitmaps.get(('gram', gram), arr)
+            if not bits:
+                return 0
+        if len(text) == 2:
+            # 只有一个二元组时不必核对
+            return bits
+        # 二元组都出现不代表连在一起, 逐个核对原文
+        texts = group.grams.texts
+        result = bytearray((bits.bit_length() + 7) // 8)
+        for doc_id in BitPool(bits):
+            if text in texts.get(doc_id, '').replace(' ', ''):
+                result[doc_id >> 3] |= 1 << (doc_id & 7)
+        return int.from_bytes(result, 'little')
+    # 普通词按分词规则切分, 各词都要出现
+    words = analyze(node[1])
+    if not words:
+        # 只有停用词, 不作限制
+        return bitmaps.universe()
+    bits = -1
+    for word in words:
+        arr = group.postings.get(word)
+        if not arr:
+            return 0
+        bits &= bitmaps.get(('word', word), arr)
+    return bits
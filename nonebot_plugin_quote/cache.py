@@ -0,0 +1,101 @@
+import asyncio
+import sqlite3
+import ujson as json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# 查询结果缓存 (LRU)
+# 键为 (群号, 规范化后的查询), 值为候选文档id池与写入时该群索引的 generation
+# 群索引每次修改都会让 generation 加一, 取出时 generation 不一致即视为失效
+class QueryCache:
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, generation):
+        entry = self._data.get(key)
+        if entry is None or entry[0] != generation:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, generation, pool):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (generation, pool)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+# OCR 结果缓存, 键为图片内容的md5(加上预处理选项), 值为识别出的各行文字
+# 存在 SQLite 中, 重启后仍有效; 超过上限时淘汰最久未使用的条目
+# 数据库读写都在专用的单线程中进行, 不阻塞事件循环
+class OcrCache:
+
+    def __init__(self, db_path, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._executor = ThreadPoolExecutor(1)
+        # 连接只在上面的单线程中使用
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS ocr (hash TEXT PRIMARY KEY, texts TEXT NOT NULL, used INTEGER NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ocr_used ON ocr (used)')
+        self.conn.commit()
+        self._size, self._clock = self.conn.execute('SELECT COUNT(*), COALESCE(MAX(used), 0) FROM ocr').fetchone()
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _get(self, key):
+        row = self.conn.execute('SELECT texts FROM ocr WHERE hash = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        with self.conn:
+            self.conn.execute('UPDATE ocr SET used = ? WHERE hash = ?', (self._tick(), key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def _put(self, key, texts):
+        exists = self.conn.execute('SELECT 1 FROM ocr WHERE hash = ?', (key,)).fetchone() is not None
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO ocr VALUES (?, ?, ?)',
+                              (key, json.dumps(texts, ensure_ascii=False), self._tick()))
+            if not exists:
+                self._size += 1
+            if self._size > self.maxsize:
+                self.conn.execute('DELETE FROM ocr WHERE hash IN (SELECT hash FROM ocr ORDER BY used LIMIT ?)',
+                                  (self._size - self.maxsize,))
+                self._size = self.maxsize
+
+    async def get(self, key):
+        return await self._call(self._get, key)
+
+    async def put(self, key, texts):
+        if self.maxsize <= 0:
+            return
+        await self._call(self._put, key, texts)
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': self._size, 'maxsize': self.maxsize}
+
+    async def aclose(self):
+        await self._call(self.conn.close)
+        self._executor.shutdown()
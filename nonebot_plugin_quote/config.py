@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Extra
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 
 class Config(BaseModel, extra=Extra.ignore):
@@ -12,6 +12,29 @@ class Config(BaseModel, extra=Extra.ignore):
     quote_startcmd: str = ''
     quote_path: str = 'quote'
     emulating_font_path: str = ''
+    quote_index_dir: str = ''
+    quote_flush_interval: float = 1.0
+    quote_flush_threshold: int = 50
+    quote_compact_threshold: int = 1000
+    quote_compact_interval: int = 300
+    quote_storage: str = 'json'
+    quote_db_path: str = ''
+    quote_search_topk: int = 3
+    quote_fuzzy_ratio: float = 0.6
+    quote_query_cache_size: int = 256
+    quote_jieba_cache: str = ''
+    quote_stopwords: Optional[List[str]] = None
+    quote_reindex_batch: int = 100
+    quote_ocr_workers: int = 1
+    quote_ocr_queue: int = 16
+    quote_ocr_timeout: float = 60.0
+    quote_ocr_cache_size: int = 10000
+    quote_ocr_cache_path: str = ''
+    quote_ocr_batch_size: int = 8
+    quote_ocr_batch_window: float = 0.02
+    quote_ocr_lazy: bool = False
+    quote_ocr_preprocess: bool = False
+    quote_ocr_text_height: int = 48
 
 def check_font(emulating_font_path):
     # 判断字体是否配置
@@ -0,0 +1,543 @@
+import os
+import math
+import random
+import heapq
+from collections import deque
+from array import array
+from bisect import bisect_left
+from .analyzer import ANALYZER_VERSION, DEFAULT_STOPWORDS, normalize, normalize_text, normalize_tags, filter_words, \
+    stopword_list
+
+
+# 图片名的各种写法 -> 查找键
+# 适配器回复里给出的可能是完整文件名、去掉上传者前缀的md5文件名, 或Lagrange的大写文件名(扩展名也可能不同)
+def name_keys(name):
+    name = os.path.basename(name).lower()
+    keys = [name]
+    stem = os.path.splitext(name)[0]
+    if stem != name:
+        keys.append(stem)
+    prefix, sep, rest = name.partition('_')
+    if sep and rest and prefix.isdigit():
+        keys.append(rest)
+        keys.append(os.path.splitext(rest)[0])
+    return keys
+
+
+# 上传者: 文件名为 <上传者qq>_<md5>.<扩展名>, 没有前缀时为 None
+def author_of(name):
+    prefix, sep, _ = os.path.basename(name).partition('_')
+    return prefix if sep else None
+
+
+# 有序文档id数组的插入/删除, postings 为 键 -> 数组 的字典, 数组为空时删除该键
+def insert_posting(postings, key, doc_id):
+    arr = postings.get(key)
+    if arr is None:
+        postings[key] = array('I', (doc_id,))
+    elif arr[-1] < doc_id:
+        # 新文档id最大, 直接追加即可保持有序
+        arr.append(doc_id)
+    else:
+        i = bisect_left(arr, doc_id)
+        if i == len(arr) or arr[i] != doc_id:
+            arr.insert(i, doc_id)
+
+
+def remove_posting(postings, key, doc_id):
+    arr = postings.get(key)
+    if arr is None:
+        return False
+    i = bisect_left(arr, doc_id)
+    if i == len(arr) or arr[i] != doc_id:
+        return False
+    del arr[i]
+    if len(arr) == 0:
+        del postings[key]
+    return True
+
+
+# 字二元组 (按空格分段, 不跨段)
+def bigrams(text):
+    grams = set()
+    for seg in text.split():
+        for i in range(len(seg) - 1):
+            grams.add(seg[i:i + 2])
+    return grams
+
+
+def _contains(arr, doc_id):
+    i = bisect_left(arr, doc_id)
+    return i < len(arr) and arr[i] == doc_id
+
+
+# 单个群的字二元组索引, 用于OCR文本的子串/模糊匹配
+# OCR 常把词切错或认错个别字, jieba 分词对不上时, 按查询与语录共有的二元组数打分
+class NgramIndex:
+
+    def __init__(self):
+        self.postings = {}  # 二元组 -> 有序文档id数组
+        self.texts = {}     # 文档id -> 规范化文本
+
+    def add(self, doc_id, text):
+        self.remove(doc_id)
+        self.texts[doc_id] = text
+        for gram in bigrams(text):
+            insert_posting(self.postings, gram, doc_id)
+
+    def remove(self, doc_id):
+        text = self.texts.pop(doc_id, None)
+        if text is None:
+            return
+        for gram in bigrams(text):
+            remove_posting(self.postings, gram, doc_id)
+
+    # 返回至少命中 ratio 比例二元组的文档中得分最高的 topk 个, 包含整个查询子串的排在最前
+    def search(self, query, ratio, topk):
+        query = normalize_text(query)
+        grams = bigrams(query)
+        if not grams:
+            return []
+        lists = sorted((self.postings.get(gram, array('I')) for gram in grams), key=len)
+        need = max(1, math.ceil(len(lists) * ratio))
+        # 命中至少 need 个二元组的文档必然出现在最短的 len - need + 1 个表中, 只从这些表取候选
+        split = len(lists) - need + 1
+        hits = {}
+        for arr in lists[:split]:
+            for doc_id in arr:
+                hits[doc_id] = hits.get(doc_id, 0) + 1
+        scores = {}
+        for doc_id, count in hits.items():
+            for j in range(split, len(lists)):
+                if count + len(lists) - j < need:
+                    break
+                if _contains(lists[j], doc_id):
+                    count += 1
+            if count >= need:
+                if count == len(lists) and query in self.texts.get(doc_id, ''):
+                    count += 1
+                scores[doc_id] = count
+        return heapq.nlargest(topk, scores, key=scores.__getitem__)
+
+    def encode(self):
+        grams = list(self.postings)
+        lens = array('I', map(len, self.postings.values()))
+        flat = array('I')
+        for arr in self.postings.values():
+            flat.extend(arr)
+        return grams, [lens, flat]
+
+    def decode(self, texts, grams, arrays):
+        lens, flat = arrays
+        self.texts = texts
+        offset = 0
+        for gram, length in zip(grams, lens):
+            self.postings[gram] = flat[offset:offset + length]
+            offset += length
+
+
+# 不重复的随机抽取 (边抽边洗牌)
+# items[:cursor] 为本轮已抽过的, 每次从未抽过的部分随机取一个换到 cursor 处, 全部抽完后开始新一轮
+# 新加入的放在末尾(未抽过), 删除时保持已抽/未抽的划分, 都是 O(1)
+class ShuffleBag:
+
+    def __init__(self, items=None, cursor=0):
+        self.items = array('I') if items is None else items
+        self.pos = {doc_id: i for i, doc_id in enumerate(self.items)}    # 文档id -> 在 items 中的位置
+        self.cursor = min(cursor, len(self.items))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def _put(self, i, doc_id):
+        self.items[i] = doc_id
+        self.pos[doc_id] = i
+
+    def add(self, doc_id):
+        if doc_id in self.pos:
+            return False
+        self.pos[doc_id] = len(self.items)
+        self.items.append(doc_id)
+        return True
+
+    def remove(self, doc_id):
+        pos = self.pos.pop(doc_id, None)
+        if pos is None:
+            return False
+        if pos < self.cursor:
+            # 已抽过的部分少一个: 用其中最后一个填补空位, 空位移到分界处
+            self.cursor -= 1
+            if pos != self.cursor:
+                self._put(pos, self.items[self.cursor])
+                pos = self.cursor
+        last = self.items.pop()
+        if pos < len(self.items):
+            self._put(pos, last)
+        return True
+
+    # 把本轮已抽过的文档移到前面, 用于从快照恢复抽取进度
+    def restore(self, drawn):
+        for doc_id in drawn:
+            pos = self.pos.get(doc_id)
+            if pos is None or pos < self.cursor:
+                continue
+            if pos != self.cursor:
+                other = self.items[self.cursor]
+                self._put(pos, other)
+                self._put(self.cursor, doc_id)
+            self.cursor += 1
+
+    def draw(self):
+        n = len(self.items)
+        if n == 0:
+            return None
+        if self.cursor >= n:
+            self.cursor = 0
+        j = random.randrange(self.cursor, n)
+        doc_id = self.items[j]
+        if j != self.cursor:
+            self._put(j, self.items[self.cursor])
+            self._put(self.cursor, doc_id)
+        self.cursor += 1
+        return doc_id
+
+
+# 旧数据没有原文, 用分词代替, 各词之间不组成二元组
+def words_text(words):
+    return ' '.join(normalize_text(word) for word in words)
+
+
+# 单个群的索引
+# 图片文件名只保存一次, 倒排表中存放整数文档id的有序数组 (array('I'))
+# 旧的 record.json / inverted_index.json 表由 load 载入
+class GroupIndex:
+
+    def __init__(self):
+        self.names = []     # 文档id -> 文件名, 删除后置为 None
+        self.ids = {}       # 文件名 -> 文档id
+        self.records = ShuffleBag() # 语录记录 (文档id), 随机发送时不重复抽取
+        self.postings = {}  # 词 -> 有序文档id数组
+        self.terms = {}     # 文档id -> 词集合 (正排)
+        self.aliases = {}   # 查找键 -> 文档id
+        self.generation = 0 # 每次修改加一
+        self.changes = deque(maxlen=256)    # 最近修改的 (generation, 文档id), 供位图缓存增量更新
+        self.total_len = 0  # 所有文档的词数之和, 用于BM25的平均文档长度
+        self.grams = NgramIndex()   # 字二元组索引
+        self.authors = {}   # 上传者 -> 该上传者的语录记录 (ShuffleBag)
+        self.tags = {}      # 手动标签 -> 有序文档id数组, 与分词的倒排表分开
+        self.doc_tags = {}  # 文档id -> 标签集合
+        self.analyzer = ANALYZER_VERSION    # 建索引时的分析规则版本, 低于当前版本时需要重建
+        self.stopwords = stopword_list()    # 建索引时的停用词, 与当前配置不同时需要重建
+        self.reindex_pos = 0    # 重建进度 (下一个文档id)
+        self.bitmaps = None     # 组合查询的位图缓存 (boolquery.Bitmaps), 第一次组合查询时创建
+
+    def intern(self, name):
+        doc_id = self.ids.get(name)
+        if doc_id is None:
+            doc_id = len(self.names)
+            self.names.append(name)
+            self.ids[name] = doc_id
+            self._add_aliases(name, doc_id)
+        return doc_id
+
+    def _add_aliases(self, name, doc_id):
+        keys = name_keys(name)
+        # 完整文件名优先, 派生的键不覆盖已有的
+        self.aliases[keys[0]] = doc_id
+        for key in keys[1:]:
+            self.aliases.setdefault(key, doc_id)
+
+    def add_posting(self, word, doc_id):
+        insert_posting(self.postings, word, doc_id)
+
+    def remove_posting(self, word, doc_id):
+        return remove_posting(self.postings, word, doc_id)
+
+    def add_record(self, doc_id):
+        if self.records.add(doc_id):
+            self._add_author(doc_id)
+
+    def remove_record(self, doc_id):
+        if not self.records.remove(doc_id):
+            return False
+        self._remove_author(doc_id)
+        return True
+
+    def _add_author(self, doc_id):
+        author = author_of(self.names[doc_id])
+        if author is None:
+            return
+        bag = self.authors.get(author)
+        if bag is None:
+            bag = self.authors[author] = ShuffleBag()
+        bag.add(doc_id)
+
+    def _remove_author(self, doc_id):
+        author = author_of(self.names[doc_id])
+        bag = self.authors.get(author)
+        if bag is None:
+            return
+        bag.remove(doc_id)
+        if not bag:
+            del self.authors[author]
+
+    # 写入一张图片的分词与原文, 重复写入时覆盖旧的
+    # 没有原文(旧数据)时用分词拼接代替
+    def offer(self, name, words, text=None):
+        doc_id = self.intern(name)
+        self._touch(doc_id)
+        self._set_terms(doc_id, set(words))
+        self.grams.add(doc_id, normalize_text(text) if text is not None else words_text(self.terms[doc_id]))
+        self.add_record(doc_id)
+        return doc_id
+
+    def _set_terms(self, doc_id, words):
+        old = self.terms.get(doc_id, set())
+        for word in old - words:
+            self.remove_posting(word, doc_id)
+        for word in words - old:
+            self.add_posting(word, doc_id)
+        self.terms[doc_id] = words
+        self.total_len += len(words) - len(old)
+
+    # 按当前分析规则重建 [start, start + count) 的文档: 词和标签重新规范化, 二元组重新生成
+    # 原文不保存, 分词结果直接按新规则转换; 可重复执行, 返回下一批的起点
+    # restore 为不再是停用词的词, 旧索引中没有, 按原文(字二元组索引中的文本)补回
+    def reindex(self, start, count, restore=()):
+        self.generation += 1
+        end = min(start + count, len(self.names))
+        for doc_id in range(start, end):
+            if self.names[doc_id] is None:
+                continue
+            self.changes.append((self.generation, doc_id))
+            words = self.terms.get(doc_id)
+            if words is not None:
+                words = set(filter_words(normalize(word) for word in words))
+                if restore:
+                    text = self.grams.texts.get(doc_id, '').replace(' ', '')
+                    words.update(word for word in restore if word in text)
+                self._set_terms(doc_id, words)
+            tags = self.doc_tags.get(doc_id)
+            if tags:
+                new_tags = set(normalize_tags(tags))
+                for tag in tags - new_tags:
+                    remove_posting(self.tags, tag, doc_id)
+                for tag in new_tags - tags:
+                    insert_posting(self.tags, tag, doc_id)
+                self.doc_tags[doc_id] = new_tags
+            text = self.grams.texts.get(doc_id)
+            if text is not None:
+                new_text = ' '.join(normalize_text(seg) for seg in text.split())
+                if new_text != text:
+                    self.grams.add(doc_id, new_text)
+        return end
+
+    # 按适配器给出的图片名查找文档id
+    def resolve(self, img_name):
+        img_name = os.path.basename(img_name).lower()
+        for key in (img_name, os.path.splitext(img_name)[0]):
+            doc_id = self.aliases.get(key)
+            if doc_id is not None:
+                return doc_id
+        return None
+
+    # 只从该文档自己的词的倒排表中移除, 不扫描整个词表
+    def remove(self, doc_id):
+        self._touch(doc_id)
+        check = False
+        words = self.terms.pop(doc_id, ())
+        self.total_len -= len(words)
+        self.grams.remove(doc_id)
+        for word in words:
+            check = self.remove_posting(word, doc_id) or check
+        for tag in self.doc_tags.pop(doc_id, ()):
+            remove_posting(self.tags, tag, doc_id)
+        check = self.remove_record(doc_id) or check
+        for key in name_keys(self.names[doc_id]):
+            if self.aliases.get(key) == doc_id:
+                del self.aliases[key]
+        del self.ids[self.names[doc_id]]
+        self.names[doc_id] = None
+        return check
+
+    def _touch(self, doc_id):
+        self.generation += 1
+        self.changes.append((self.generation, doc_id))
+
+    def add_tags(self, doc_id, tags):
+        self._touch(doc_id)
+        doc_tags = self.doc_tags.setdefault(doc_id, set())
+        for tag in tags:
+            if tag not in doc_tags:
+                doc_tags.add(tag)
+                insert_posting(self.tags, tag, doc_id)
+
+    # 同时从分词中删除, 用于去掉识别错误的词和旧版本混在分词里的标签
+    def del_tags(self, doc_id, tags):
+        self._touch(doc_id)
+        doc_tags = self.doc_tags.get(doc_id, set())
+        words = self.terms.get(doc_id, set())
+        for tag in tags:
+            if tag in doc_tags:
+                doc_tags.remove(tag)
+                remove_posting(self.tags, tag, doc_id)
+            if tag in words:
+                words.remove(tag)
+                self.total_len -= 1
+                self.remove_posting(tag, doc_id)
+        if not doc_tags:
+            self.doc_tags.pop(doc_id, None)
+
+    # 标签 -> 使用次数, 从多到少
+    def tag_counts(self, limit):
+        return heapq.nlargest(limit, ((tag, len(arr)) for tag, arr in self.tags.items()), key=lambda item: item[1])
+
+    def record_names(self):
+        return [self.names[i] for i in self.records.items]
+
+    @classmethod
+    def load(cls, records, inverted):
+        group = cls()
+        for name in records:
+            group.add_record(group.intern(name))
+        for word, imgs in inverted.items():
+            if not imgs:
+                continue
+            doc_ids = sorted({group.intern(name) for name in imgs})
+            group.postings[word] = array('I', doc_ids)
+            for doc_id in doc_ids:
+                group.terms.setdefault(doc_id, set()).add(word)
+        group.total_len = sum(map(len, group.terms.values()))
+        group.build_grams()
+        # json表中的词是旧规则下的
+        group.analyzer = 0
+        return group
+
+    def build_grams(self):
+        for doc_id, words in self.terms.items():
+            self.grams.add(doc_id, words_text(words))
+
+    # 二进制快照: 文件名和词表走json, 记录/倒排/正排都是 array('I') 的原始字节
+    # 正排存为词id数组, 启动时不再从倒排表重建
+    def encode(self):
+        words = list(self.postings)
+        word_ids = {word: i for i, word in enumerate(words)}
+        posting_lens = array('I', map(len, self.postings.values()))
+        postings = array('I')
+        for arr in self.postings.values():
+            postings.extend(arr)
+        doc_ids = array('I', self.terms)
+        term_lens = array('I', map(len, self.terms.values()))
+        terms = array('I', [word_ids[word] for doc_terms in self.terms.values() for word in doc_terms])
+        alias_ids = array('I', self.aliases.values())
+        grams, gram_arrays = self.grams.encode()
+        texts = [self.grams.texts.get(doc_id) for doc_id in range(len(self.names))]
+        tag_lens = array('I', map(len, self.tags.values()))
+        tag_postings = array('I')
+        for arr in self.tags.values():
+            tag_postings.extend(arr)
+        meta = {'names': self.names, 'words': words, 'aliases': list(self.aliases), 'texts': texts, 'grams': grams,
+                'cursor': self.records.cursor, 'tags': list(self.tags),
+                'author_drawn': {author: list(bag.items[:bag.cursor]) for author, bag in self.authors.items()
+                                 if bag.cursor},
+                'analyzer': self.analyzer, 'stopwords': self.stopwords, 'reindex_pos': self.reindex_pos}
+        return meta, [self.records.items, posting_lens, postings, doc_ids, term_lens, terms, alias_ids, *gram_arrays,
+                      tag_lens, tag_postings]
+
+    @classmethod
+    def decode(cls, meta, arrays):
+        records, posting_lens, postings, doc_ids, term_lens, terms, alias_ids = arrays[:7]
+        group = cls()
+        group.names = meta['names']
+        words = meta['words']
+        group.ids = {name: doc_id for doc_id, name in enumerate(group.names) if name is not None}
+        group.aliases = dict(zip(meta['aliases'], alias_ids))
+        group.analyzer = meta.get('analyzer', 0)
+        # 没有保存停用词的旧快照是按默认停用词建立的
+        group.stopwords = meta.get('stopwords', sorted(normalize(word) for word in DEFAULT_STOPWORDS))
+        group.reindex_pos = meta.get('reindex_pos', 0)
+        # 记录的顺序与抽取位置一起保存, 重启后接着上一轮抽
+        group.records = ShuffleBag(records, meta.get('cursor', 0))
+        # 上传者索引由文件名得出, 只在快照中保存各上传者本轮已抽过的文档
+        for doc_id in records:
+            group._add_author(doc_id)
+        for author, drawn in meta.get('author_drawn', {}).items():
+            if author in group.authors:
+                group.authors[author].restore(drawn)
+        offset = 0
+        for word, length in zip(words, posting_lens):
+            group.postings[word] = postings[offset:offset + length]
+            offset += length
+        offset = 0
+        for doc_id, length in zip(doc_ids, term_lens):
+            group.terms[doc_id] = {words[i] for i in terms[offset:offset + length]}
+            offset += length
+        group.total_len = sum(term_lens)
+        if 'grams' in meta:
+            texts = {doc_id: text for doc_id, text in enumerate(meta['texts']) if text is not None}
+            group.grams.decode(texts, meta['grams'], arrays[7:9])
+        else:
+            # 没有二元组索引的旧快照
+            group.build_grams()
+        if 'tags' in meta:
+            tag_lens, tag_postings = arrays[9:11]
+            offset = 0
+            for tag, length in zip(meta['tags'], tag_lens):
+                arr = group.tags[tag] = tag_postings[offset:offset + length]
+                offset += length
+                for doc_id in arr:
+                    group.doc_tags.setdefault(doc_id, set()).add(tag)
+        return group
+
+
+# 结果与下一个数组的长度比小于该值时才使用跳跃查找
+GALLOP_RATIO = 32
+
+
+# 在有序数组 arr 的 [lo, len) 中找第一个 >= target 的位置
+# 先按 1, 2, 4, ... 的步长向后跳, 再在最后一段里二分
+def gallop(arr, target, lo):
+    n = len(arr)
+    step = 1
+    hi = lo
+    while hi < n and arr[hi] < target:
+        lo = hi + 1
+        hi += step
+        step <<= 1
+    return bisect_left(arr, target, lo, min(hi, n))
+
+
+# 有序文档id数组求交集: 从最短的数组开始, 结果为空时立即结束
+# 当前结果远短于下一个数组时在其中跳跃查找, 长度相近时跳跃没有收益, 改用集合求交
+def intersect(arrays):
+    arrays = sorted(arrays, key=len)
+    result = arrays[0]
+    for arr in arrays[1:]:
+        if not result:
+            break
+        if len(result) * GALLOP_RATIO > len(arr):
+            result = array('I', sorted(set(result).intersection(arr)))
+            continue
+        matched = array('I')
+        pos = 0
+        for doc_id in result:
+            pos = gallop(arr, doc_id, pos)
+            if pos == len(arr):
+                break
+            if arr[pos] == doc_id:
+                matched.append(doc_id)
+                pos += 1
+        result = matched
+    return result
+
+
+# json表 -> 各群索引
+def load_index(record_dict, inverted_index):
+    index = {}
+    for group_id in {*record_dict, *inverted_index}:
+        index[group_id] = GroupIndex.load(record_dict.get(group_id, []), inverted_index.get(group_id, {}))
+    return index
+
@@ -0,0 +1,56 @@
+import os
+import ujson as json
+from nonebot.log import logger
+from .storage import atomic_write
+
+
+# 语录库数据格式的升级步骤, 每一步只在数据版本低于它时执行一次
+# 版本号记录在 meta 文件中, record.json / inverted_index.json 格式保持不变
+
+# v1: 绝对路径改为文件名
+def _to_basename(record_dict, inverted_index):
+    for i in record_dict:
+        record_dict[i] = [os.path.basename(val) for val in record_dict[i]]
+    for i in inverted_index:
+        for j in inverted_index[i]:
+            inverted_index[i][j] = [os.path.basename(val) for val in inverted_index[i][j]]
+    logger.info('已去除语录数据库中的绝对路径内容')
+
+
+# v2: 去除重复内容
+def _dedupe(record_dict, inverted_index):
+    for i in record_dict:
+        record_dict[i] = list(dict.fromkeys(record_dict[i]))
+    for i in inverted_index:
+        for j in inverted_index[i]:
+            inverted_index[i][j] = list(dict.fromkeys(inverted_index[i][j]))
+    logger.info('已去除语录数据库中的重复内容')
+
+
+MIGRATIONS = [
+    (1, _to_basename),
+    (2, _dedupe),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def read_version(meta_path):
+    try:
+        with open(meta_path, 'r', encoding='UTF-8') as f:
+            return json.load(f).get('schema_version', 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_version(meta_path, version):
+    atomic_write(meta_path, json.dumps({'schema_version': version}))
+
+
+# 依次执行未做过的升级, 返回是否有改动
+def migrate(record_dict, inverted_index, version):
+    changed = False
+    for target, step in MIGRATIONS:
+        if version < target:
+            step(record_dict, inverted_index)
+            changed = True
+    return changed
@@ -0,0 +1,245 @@
+import os
+import sys
+import asyncio
+import hashlib
+import ujson as json
+from nonebot.log import logger
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ocr_worker.py')
+
+
+class OcrBusy(Exception):
+    pass
+
+
+# 识别结果去掉空行与重复行, 按原顺序用空格连接
+def join_texts(texts):
+    return ''.join(f'{line} ' for line in dict.fromkeys(texts) if line != '')
+
+
+def file_md5(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+# OCR 进程池: 每个工作进程各自加载并预热一个 PaddleOCR, 识别不占用事件循环与默认线程池
+# 提交队列有上限, 排满时直接拒绝; 单次识别超时或进程崩溃时结束该进程并重新启动(lazy 时推迟到下一次识别)
+# 有 cache 时按图片内容的md5缓存识别结果, 重复上传的图片不再识别
+# 批量识别: 工作进程取到一张图片后最多再等 batch_window 秒, 把这期间提交的图片(至多 batch_size 张)合成一次 predict
+# 模型在驱动启动后于后台加载(lazy 时推迟到第一次识别), 就绪前提交的图片排队等待, 不会被拒绝
+class OcrPool:
+
+    def __init__(self, workers=1, queue_size=16, timeout=60.0, cache=None, batch_size=8, batch_window=0.02, lazy=False,
+                 preprocess=False, text_height=48):
+        self.workers = max(1, workers)
+        self.cache = cache
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.batch_size = max(1, batch_size)
+        self.batch_window = batch_window
+        self.lazy = lazy
+        self.options = {'preprocess': preprocess, 'text_height': text_height}
+        self._queue = None
+        self._tasks = []
+        self._ready = 0     # 已加载好模型的进程数
+        self._loading = 0   # 正在加载模型的进程数
+
+    def start(self):
+        self._queue = asyncio.Queue(self.queue_size)
+        self._tasks = [asyncio.create_task(self._run(n)) for n in range(self.workers)]
+
+    # 至少有一个进程可以识别
+    @property
+    def ready(self):
+        return self._ready > 0
+
+    # stopped: 未启动, idle: 等待第一次识别时加载, loading: 模型加载中(包括进程重启), ready: 可以识别
+    @property
+    def state(self):
+        if self._queue is None:
+            return 'stopped'
+        if self._ready > 0:
+            return 'ready'
+        if self._loading > 0 or not self.lazy:
+            return 'loading'
+        return 'idle'
+
+    # rendered: 由语录模板生成的图片, 预处理时只保留气泡区域
+    async def recognize(self, image_path, rendered=False):
+        if self._queue is None:
+            raise RuntimeError('OCR进程池未启动')
+        future = asyncio.get_running_loop().create_future()
+        task = {'path': image_path, 'rendered': rendered}
+        if self.ready:
+            try:
+                self._queue.put_nowait((task, future))
+            except asyncio.QueueFull:
+                raise OcrBusy('OCR队列已满') from None
+        else:
+            logger.info('OCR模型尚未就绪, 图片排队等待识别')
+            await self._queue.put((task, future))
+        return await future
+
+    # 识别失败(队列已满、超时、进程崩溃等)时记录日志并返回 None, 由调用方提示用户
+    # 识别成功但没有文字时返回空字符串
+    # digest 为图片内容的md5, 调用方已算过时直接传入
+    async def recognize_text(self, image_path, digest=None, rendered=False):
+        try:
+            key = None
+            if self.cache is not None:
+                if digest is None:
+                    digest = await asyncio.get_running_loop().run_in_executor(None, file_md5, image_path)
+                key = self._cache_key(digest, rendered)
+                texts = await self.cache.get(key)
+                if texts is not None:
+                    return join_texts(texts)
+            texts = await self.recognize(image_path, rendered)
+            if key is not None:
+                await self.cache.put(key, texts)
+            return join_texts(texts)
+        except Exception as e:
+            logger.error(f'OCR识别失败: {e}')
+            return None
+
+    # 预处理方式不同时识别结果可能不同, 一并作为缓存键
+    def _cache_key(self, digest, rendered):
+        if not self.options['preprocess']:
+            return digest
+        return f"{digest}:{int(rendered)}:{self.options['text_height']}"
+
+    async def _spawn(self, n):
+        self._loading += 1
+        try:
+            process = await asyncio.create_subprocess_exec(sys.executable, WORKER_SCRIPT, json.dumps(self.options),
+                                                           stdin=asyncio.subprocess.PIPE,
+                                                           stdout=asyncio.subprocess.PIPE,
+                                                           limit=2 ** 20)
+            try:
+                # 等待模型加载与预热完成
+                await self._read(process)
+            except BaseException:
+                await self._kill(process)
+                raise
+        finally:
+            self._loading -= 1
+        self._ready += 1
+        logger.info(f'OCR进程{n}已就绪')
+        return process
+
+    async def _read(self, process):
+        line = await process.stdout.readline()
+        if not line:
+            raise ConnectionError('OCR进程已退出')
+        return json.loads(line)
+
+    async def _stop(self, process):
+        self._ready -= 1
+        await self._kill(process)
+
+    async def _kill(self, process):
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        await process.wait()
+
+    # 返回与 tasks 顺序一致的结果, 每项为文字列表或异常
+    async def _call(self, process, tasks):
+        process.stdin.write((json.dumps({'tasks': tasks}, ensure_ascii=False) + '\n').encode('UTF-8'))
+        await process.stdin.drain()
+        # 超时不随批量增大, 卡住的一批最多占用该进程 timeout 秒
+        reply = await asyncio.wait_for(self._read(process), self.timeout)
+        return [RuntimeError(res['error']) if 'error' in res else res['texts'] for res in reply['results']]
+
+    # 取出一批任务: 第一张到达后最多等待 batch_window 秒
+    async def _collect(self):
+        jobs = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(jobs) < self.batch_size:
+            if self._queue.empty():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    jobs.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                jobs.append(self._queue.get_nowait())
+        # 调用方已取消的不再识别
+        return [job for job in jobs if not job[1].done()]
+
+    @staticmethod
+    def _resolve(jobs, results):
+        for (_, future), result in zip(jobs, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _run(self, n):
+        process = None
+        try:
+            while True:
+                # 启动后即在后台加载模型, 第一次上传不必等待; 超时或崩溃后也立即重启, 不等下一张图片
+                if process is None and not self.lazy:
+                    try:
+                        process = await self._spawn(n)
+                    except (OSError, ValueError) as e:
+                        logger.error(f'OCR进程{n}启动失败: {e}')
+                jobs = await self._collect()
+                if not jobs:
+                    continue
+                batches = [(jobs, True)]
+                while batches:
+                    batch, retry = batches.pop()
+                    try:
+                        if process is None:
+                            process = await self._spawn(n)
+                        results = await self._call(process, [task for task, _ in batch])
+                    except asyncio.TimeoutError:
+                        logger.error(f'OCR进程{n}识别超时({self.timeout}秒), 已重启')
+                        await self._stop(process)
+                        process = None
+                        if len(batch) > 1:
+                            # 与崩溃时相同, 逐张重试, 只让卡住的图片失败
+                            batches.extend(([job], False) for job in reversed(batch))
+                        else:
+                            self._resolve(batch, [TimeoutError('OCR识别超时')])
+                    except (OSError, ValueError, KeyError) as e:
+                        if process is not None:
+                            await self._stop(process)
+                            process = None
+                        logger.warning(f'OCR进程{n}异常退出: {e}')
+                        if len(batch) > 1:
+                            # 整批崩溃时逐张重试, 只让导致崩溃的图片失败
+                            batches.extend(([job], False) for job in reversed(batch))
+                        elif retry:
+                            batches.append((batch, False))
+                        else:
+                            self._resolve(batch, [e])
+                    else:
+                        self._resolve(batch, results)
+        finally:
+            if process is not None:
+                await self._stop(process)
+
+    def cache_info(self):
+        return None if self.cache is None else self.cache.info()
+
+    async def aclose(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, future = self._queue.get_nowait()
+                if not future.done():
+                    future.cancel()
+        if self.cache is not None:
+            await self.cache.aclose()
@@ -0,0 +1,83 @@
+import numpy as np
+from PIL import Image, ImageChops
+
+
+# OCR 前的图片预处理, 在 OCR 子进程中执行, 只依赖 numpy 与 PIL
+# 1. 裁掉四周与背景同色的边距
+# 2. 生成的语录图只保留白色气泡区域(头像、昵称另行记录, 不需要识别)
+# 3. 按估计的文字行高缩小, 使最小的文字行高接近 text_height (PP-OCR 识别模型输入行高为48, 不宜再低)
+
+BUBBLE_COLOR = 255      # 模板中 .message-text 的背景为 #fff
+MARGIN_DIFF = 24        # 与背景色相差超过该值视为内容
+EDGE_DIFF = 40          # 左右相邻像素灰度相差超过该值视为文字边缘
+GAP = 2                 # 行段之间不超过该行数的空隙视为同一行
+MIN_TEXT = 8            # 低于该高度的行段视为边框、分隔线
+PAD = 8
+
+
+def _pad(box, size, pad=PAD):
+    left, top, right, bottom = box
+    return max(left - pad, 0), max(top - pad, 0), min(right + pad, size[0]), min(bottom + pad, size[1])
+
+
+# 四个角中出现最多的颜色作为背景色, 返回内容区域 (left, top, right, bottom)
+def trim_margin(image):
+    width, height = image.size
+    corners = [image.getpixel(xy) for xy in ((0, 0), (width - 1, 0), (0, height - 1), (width - 1, height - 1))]
+    background = max(corners, key=corners.count)
+    red, green, blue = ImageChops.difference(image, Image.new('RGB', image.size, background)).split()
+    # 任一通道相差超过阈值即为内容
+    diff = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+    box = diff.point(lambda v: 255 if v > MARGIN_DIFF else 0).getbbox()
+    return None if box is None else _pad(box, image.size)
+
+
+# 气泡内留有内边距, 纯白像素足够多的行/列才算气泡, 避免头像等处零散的白色像素
+def crop_bubble(gray, min_width=32):
+    mask = gray == BUBBLE_COLOR
+    rows = np.flatnonzero(np.count_nonzero(mask, axis=1) >= min_width)
+    cols = np.flatnonzero(np.count_nonzero(mask, axis=0) >= min_width)
+    if len(rows) == 0 or len(cols) == 0:
+        return None
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+# 文字的竖直笔画在左右相邻像素间形成明显的灰度变化, 含这种变化的连续行段高度近似为行高
+# 同一行中并排的头像、图片会让行段偏高, 取最矮的行段, 保证图中最小的文字缩小后仍然可读
+def estimate_text_height(gray):
+    edges = np.abs(np.diff(gray.astype(np.int16), axis=1)) > EDGE_DIFF
+    active = np.count_nonzero(edges, axis=1) >= 4
+    # 相邻的 0/1 变化位置即各段的起止
+    bounds = np.flatnonzero(np.diff(np.concatenate(([0], active.astype(np.int8), [0]))))
+    starts, ends = bounds[::2], bounds[1::2]
+    if len(starts) == 0:
+        return None
+    # 合并间隔很小的段(如"二""三"等字中笔画之间的空行)
+    keep = np.concatenate(([True], starts[1:] - ends[:-1] > GAP))
+    runs = np.maximum.reduceat(ends, np.flatnonzero(keep)) - starts[keep]
+    runs = runs[runs >= MIN_TEXT]
+    if len(runs) == 0:
+        return None
+    return int(runs.min())
+
+
+def preprocess(path, text_height=48, rendered=False):
+    image = Image.open(path).convert('RGB')
+    box = trim_margin(image)
+    if box is not None:
+        image = image.crop(box)
+    gray = np.asarray(image.convert('L'))
+    if rendered:
+        box = crop_bubble(gray)
+        if box is not None:
+            image = image.crop(box)
+            gray = gray[box[1]:box[3], box[0]:box[2]]
+    if text_height > 0:
+        estimated = estimate_text_height(gray)
+        if estimated is not None and estimated > text_height:
+            # 只缩小不放大, 缩小倍数有下限, 避免估计偏差时把图缩得过小
+            scale = max(text_height / estimated, 0.25)
+            size = (max(int(image.width * scale), 1), max(int(image.height * scale), 1))
+            image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    # PaddleOCR 的数组输入为 BGR 顺序
+    return np.ascontiguousarray(np.asarray(image)[:, :, ::-1])
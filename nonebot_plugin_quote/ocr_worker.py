@@ -0,0 +1,57 @@
+import os
+import sys
+import json
+# 以脚本方式运行时, 本目录在 sys.path 中
+from ocr_preprocess import preprocess
+
+
+# OCR 子进程: 以脚本方式运行, 不导入插件包(也不会初始化nonebot)
+# 从 stdin 逐行读取一批图片, 向 stdout 逐行写回这一批的识别结果
+# 启动参数为json格式的选项: preprocess 是否预处理, text_height 预处理时缩放的目标行高
+
+
+# 预处理失败时直接识别原图
+def load(task, options):
+    if not options.get('preprocess'):
+        return task['path']
+    try:
+        return preprocess(task['path'], options.get('text_height', 48), task.get('rendered', False))
+    except Exception as e:
+        print(f'OCR预处理失败: {e}', file=sys.stderr)
+        return task['path']
+
+
+def main():
+    options = json.loads(sys.argv[1]) if len(sys.argv) > 1 else {}
+    out = os.fdopen(os.dup(1), 'w', encoding='UTF-8')
+    # PaddleOCR 的日志不能混进结果流, 统一转到 stderr
+    os.dup2(2, 1)
+    from paddleocr import PaddleOCR
+    ocr = PaddleOCR(use_angle_cls=True, lang='ch')
+    try:
+        import numpy as np
+        ocr.predict(np.zeros((100, 100, 3), dtype=np.uint8))
+    except Exception:
+        pass
+    out.write(json.dumps({'ready': True}) + '\n')
+    out.flush()
+    for line in sys.stdin:
+        tasks = json.loads(line)['tasks']
+        images = [load(task, options) for task in tasks]
+        try:
+            # 一批图片一次识别, 结果与输入顺序一致
+            results = [{'texts': list(res['rec_texts'])} for res in ocr.predict(images)]
+        except Exception:
+            # 整批失败时逐张识别, 一张坏图不影响其他图片
+            results = []
+            for image in images:
+                try:
+                    results.append({'texts': list(ocr.predict(image)[0]['rec_texts'])})
+                except Exception as e:
+                    results.append({'error': str(e)})
+        out.write(json.dumps({'results': results}, ensure_ascii=False) + '\n')
+        out.flush()
+
+
+if __name__ == '__main__':
+    main()
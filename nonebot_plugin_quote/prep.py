@@ -1,29 +1,31 @@
 import ujson as json
-from paddleocr import PaddleOCR
 from .config import Config, check_font
 from nonebot import get_driver
 from nonebot.rule import to_me
 import os
 from nonebot.log import logger
-from .task import inverted2forward
-
-ocr = PaddleOCR(use_angle_cls=True, lang='ch')
-try:
-    import numpy as np
-    dummy = np.zeros((100,100,3), dtype=np.uint8)
-    ocr.predict(dummy)
-except Exception:
-    pass
+import asyncio
+from .index import load_index
+from .migrate import SCHEMA_VERSION, migrate, read_version, write_version
+from .storage import atomic_write, load_shards, write_shard, shards_complete, mark_shards_complete
+from .store import MemoryStore
+from .sqlite_store import SqliteStore
+from .service import QuoteService
+from .task import warmup_jieba
+from .analyzer import set_stopwords
+from .ocr import OcrPool
+from .cache import OcrCache
 
 plugin_config = Config.model_validate(get_driver().config.model_dump())
 plugin_config.global_superuser = list({*plugin_config.global_superuser, *plugin_config.superusers})
 
+if plugin_config.quote_stopwords is not None:
+    set_stopwords(plugin_config.quote_stopwords)
+
 need_at = {}
 if (plugin_config.quote_needat):
     need_at['rule'] = to_me()
 
-record_dict = {}
-inverted_index = {}
 quote_path = plugin_config.quote_path
 emulating_font_path = plugin_config.emulating_font_path
 
@@ -35,64 +37,128 @@ os.makedirs(quote_path, exist_ok=True)
 
 if not check_font(emulating_font_path):
     logger.warning('未配置字体路径，部分功能无法使用')
-    
-# 首次运行时导入表
-try:
-    with open(plugin_config.record_path, 'r', encoding='UTF-8') as fr:
-        record_dict = json.load(fr)
-
-    with open(plugin_config.inverted_index_path, 'r', encoding='UTF-8') as fi:
-        inverted_index = json.load(fi)
-    logger.info('nonebot_plugin_quote路径配置成功')
-except Exception as e:
-    with open(plugin_config.record_path, 'w', encoding='UTF-8') as f:
-        json.dump(record_dict, f, indent=4, ensure_ascii=False)
-
-    with open(plugin_config.inverted_index_path, 'w', encoding='UTF-8') as fc:
-        json.dump(inverted_index, fc, indent=4, ensure_ascii=False)
-    logger.warning('已创建json文件')
-
-# 运行前去除数据中的重复内容
-try:
-    for i in record_dict:
-        record_dict[i] = list(set(record_dict[i]))
-    with open(plugin_config.record_path, 'w', encoding='UTF-8') as f:
-        json.dump(record_dict, f, indent=4, ensure_ascii=False)
-
-    for i in inverted_index:
-        for j in inverted_index[i]:
-            inverted_index[i][j] = list(set(inverted_index[i][j]))
-    with open(plugin_config.inverted_index_path, 'w', encoding='UTF-8') as f:
-        json.dump(inverted_index, f, indent=4, ensure_ascii=False)
-    logger.info('已去除语录数据库中的重复内容')
-except Exception as e:
-    logger.error(f'错误: {e}! ')
-
-# 运行前将绝对路径修改为相对路径
-try:
-    for i in record_dict:
-        for idx, val in enumerate(record_dict[i]):
-            record_dict[i][idx] = os.path.basename(val)
-    with open(plugin_config.record_path, 'w', encoding='UTF-8') as f:
-        json.dump(record_dict, f, indent=4, ensure_ascii=False)
-
-    for i in inverted_index:
-        for j in inverted_index[i]:
-            for idx, val in enumerate(inverted_index[i][j]):
-                inverted_index[i][j][idx] = os.path.basename(val)
-    with open(plugin_config.inverted_index_path, 'w', encoding='UTF-8') as f:
-        json.dump(inverted_index, f, indent=4, ensure_ascii=False)
-    logger.info('已去除语录数据库中的绝对路径内容')
-except Exception as e:
-    logger.error(f'错误: {e}! ')
-
-forward_index = inverted2forward(inverted_index)
 
+meta_path = os.path.splitext(plugin_config.inverted_index_path)[0] + '.meta.json'
 
+# 各群索引分片目录
+index_dir = plugin_config.quote_index_dir
+if index_dir == '':
+    index_dir = os.path.join(quote_path, 'index')
+os.makedirs(index_dir, exist_ok=True)
 
 def save_json(record_dict, inverted_index):
-    with open(plugin_config.record_path, 'w', encoding='UTF-8') as f:
-        json.dump(record_dict, f, indent=4, ensure_ascii=False)
-
-    with open(plugin_config.inverted_index_path, 'w', encoding='UTF-8') as fc:
-        json.dump(inverted_index, fc, indent=4, ensure_ascii=False)
\ No newline at end of file
+    atomic_write(plugin_config.record_path, json.dumps(record_dict, indent=4, ensure_ascii=False))
+    atomic_write(plugin_config.inverted_index_path, json.dumps(inverted_index, indent=4, ensure_ascii=False))
+
+
+def load_json():
+    record_dict = {}
+    inverted_index = {}
+    # 首次运行时导入表
+    try:
+        with open(plugin_config.record_path, 'r', encoding='UTF-8') as fr:
+            record_dict = json.load(fr)
+
+        with open(plugin_config.inverted_index_path, 'r', encoding='UTF-8') as fi:
+            inverted_index = json.load(fi)
+        version = read_version(meta_path)
+        logger.info('nonebot_plugin_quote路径配置成功')
+    except Exception as e:
+        save_json(record_dict, inverted_index)
+        version = SCHEMA_VERSION
+        write_version(meta_path, version)
+        logger.warning('已创建json文件')
+
+    # 旧版本数据只在第一次启动时升级并写回
+    if version < SCHEMA_VERSION:
+        try:
+            migrate(record_dict, inverted_index, version)
+            save_json(record_dict, inverted_index)
+            write_version(meta_path, SCHEMA_VERSION)
+            logger.info(f'语录库数据已由v{version}升级至v{SCHEMA_VERSION}')
+        except Exception as e:
+            logger.error(f'错误: {e}! ')
+
+    return record_dict, inverted_index
+
+
+# 各群分片已全部建立时直接读取, 否则从json表建立分片 (只在第一次启动时, 中途退出的下次重新建立)
+def load_quote_index():
+    if shards_complete(index_dir):
+        return load_shards(index_dir)
+    index = load_index(*load_json())
+    for group_id, group in index.items():
+        write_shard(index_dir, group_id, group)
+    mark_shards_complete(index_dir)
+    logger.info('已由json表建立各群语录索引分片')
+    return index, {}
+
+
+if plugin_config.quote_storage == 'sqlite':
+    db_path = plugin_config.quote_db_path
+    if db_path == '':
+        db_path = os.path.join(os.path.dirname(plugin_config.inverted_index_path), 'quote.db')
+    quote_store = SqliteStore(db_path, plugin_config.quote_search_topk)
+    # 首次启用时从已有数据迁移
+    if quote_store.is_empty():
+        if shards_complete(index_dir):
+            index, _ = load_shards(index_dir)
+        elif os.path.exists(plugin_config.inverted_index_path):
+            index = load_index(*load_json())
+        else:
+            index = {}
+        if index:
+            quote_store.import_index(index)
+            logger.info('已将语录库迁移至SQLite')
+else:
+    index, pending = load_quote_index()
+    quote_store = MemoryStore(index, index_dir, pending,
+                              plugin_config.quote_search_topk, plugin_config.quote_query_cache_size,
+                              plugin_config.quote_fuzzy_ratio)
+
+quote_service = QuoteService(quote_store, plugin_config.quote_flush_threshold)
+
+ocr_cache = None
+if plugin_config.quote_ocr_cache_size > 0:
+    ocr_cache_path = plugin_config.quote_ocr_cache_path
+    if ocr_cache_path == '':
+        ocr_cache_path = os.path.join(quote_path, 'ocr_cache.db')
+    ocr_cache = OcrCache(ocr_cache_path, plugin_config.quote_ocr_cache_size)
+ocr_pool = OcrPool(plugin_config.quote_ocr_workers, plugin_config.quote_ocr_queue, plugin_config.quote_ocr_timeout,
+                   ocr_cache, plugin_config.quote_ocr_batch_size, plugin_config.quote_ocr_batch_window,
+                   plugin_config.quote_ocr_lazy, plugin_config.quote_ocr_preprocess, plugin_config.quote_ocr_text_height)
+
+jieba_cache = plugin_config.quote_jieba_cache
+if jieba_cache == '':
+    jieba_cache = os.path.join(quote_path, 'jieba.cache')
+
+
+# OCR进程在后台加载模型, 不阻塞启动
+@get_driver().on_startup
+async def _start_ocr():
+    ocr_pool.start()
+
+
+# 后台加载jieba词典, 不阻塞启动
+@get_driver().on_startup
+async def _warmup_jieba():
+    asyncio.get_running_loop().run_in_executor(None, warmup_jieba, jieba_cache)
+
+
+# 后台刷写任务
+@get_driver().on_startup
+async def _start_flusher():
+    quote_service.start(plugin_config.quote_flush_interval,
+                        plugin_config.quote_compact_threshold,
+                        plugin_config.quote_compact_interval,
+                        plugin_config.quote_reindex_batch)
+
+
+@get_driver().on_shutdown
+async def _stop_flusher():
+    await quote_service.aclose()
+
+
+@get_driver().on_shutdown
+async def _stop_ocr():
+    await ocr_pool.aclose()
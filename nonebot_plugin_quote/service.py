@@ -0,0 +1,142 @@
+import time
+import asyncio
+from nonebot.log import logger
+from .task import cut_sentence
+
+
+# 语录索引服务: 处理器只通过这里读写索引
+# 写操作按群加 asyncio 锁, 同一个群的上传/删除/改tag/压缩依次进行, 不同群互不影响
+# 读操作不加锁, 底层索引的每次修改都在事件循环内一次完成, 读到的总是完整状态
+class QuoteService:
+
+    def __init__(self, store, flush_threshold=50):
+        self.store = store
+        self.flush_threshold = flush_threshold
+        self._locks = {}
+        self._wakeup = None
+        self._task = None
+        self._reindex_task = None
+        self._stopping = False
+
+    def lock(self, group_id):
+        lock = self._locks.get(group_id)
+        if lock is None:
+            lock = self._locks[group_id] = asyncio.Lock()
+        return lock
+
+    def _changed(self):
+        # 缓冲的变更较多时提前唤醒刷写任务
+        if self._wakeup is not None and self.store.buffered >= self.flush_threshold:
+            self._wakeup.set()
+
+    async def offer(self, group_id, img_file, content):
+        # 分词放到线程里, 不占用事件循环
+        words = await asyncio.get_running_loop().run_in_executor(None, cut_sentence, content)
+        async with self.lock(group_id):
+            self.store.offer_words(group_id, img_file, words, content)
+        self._changed()
+
+    async def delete(self, img_name, group_id):
+        async with self.lock(group_id):
+            check = self.store.delete(img_name, group_id)
+        self._changed()
+        return check
+
+    async def add_tags(self, tags, img_name, group_id):
+        async with self.lock(group_id):
+            path = self.store.add_tags(tags, img_name, group_id)
+        self._changed()
+        return path
+
+    async def del_tags(self, tags, img_name, group_id):
+        async with self.lock(group_id):
+            path = self.store.del_tags(tags, img_name, group_id)
+        self._changed()
+        return path
+
+    async def query(self, sentence, group_id):
+        return self.store.query(sentence, group_id)
+
+    # 抽取会调整记录顺序, 与压缩互斥
+    async def random_pick(self, group_id, author=None):
+        async with self.lock(group_id):
+            return self.store.random_pick(group_id, author)
+
+    async def author_count(self, group_id, author):
+        return self.store.author_count(group_id, author)
+
+    def cache_info(self):
+        return self.store.cache_info()
+
+    async def find_tags(self, img_name, group_id):
+        return self.store.find_tags(img_name, group_id)
+
+    async def tag_counts(self, group_id, limit=20):
+        return self.store.tag_counts(group_id, limit)
+
+    # 写入缓冲的日志, 压缩变更数达到 threshold 的群 (压缩期间持有该群的锁)
+    async def flush(self, threshold=1):
+        for group_id, count in self.store.dirty().items():
+            if count >= threshold:
+                async with self.lock(group_id):
+                    await self.store.compact(group_id)
+            else:
+                await self.store.write_journal(group_id)
+
+    # 后台刷写任务: 每隔 interval 秒(或缓冲达到 flush_threshold 时)把日志写入文件
+    # 单群变更达到 compact_threshold 或距上次压缩超过 compact_interval 秒时压缩该群
+    def start(self, interval, compact_threshold, compact_interval, reindex_batch=100):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(interval, compact_threshold, compact_interval))
+        if self.store.reindex_pending():
+            self._reindex_task = asyncio.create_task(self._reindex(reindex_batch))
+
+    async def _run(self, interval, compact_threshold, compact_interval):
+        last_compact = time.monotonic()
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping:
+                break
+            try:
+                if time.monotonic() - last_compact >= compact_interval:
+                    last_compact = time.monotonic()
+                    await self.flush()
+                else:
+                    await self.flush(compact_threshold)
+            except Exception as e:
+                logger.error(f'语录索引刷写失败: {e}')
+
+    # 分析规则变化后在后台重建索引: 每批持有该群的锁, 批与批之间让出事件循环
+    # 每个群完成后压缩一次, 中途关闭时进度随快照保存, 下次启动继续
+    async def _reindex(self, batch):
+        pending = self.store.reindex_pending()
+        logger.info(f'分词规则已更新, 开始在后台重建{len(pending)}个群的语录索引')
+        try:
+            for group_id in pending:
+                done = False
+                while not done:
+                    if self._stopping:
+                        return
+                    async with self.lock(group_id):
+                        done = self.store.reindex_step(group_id, batch)
+                    await asyncio.sleep(0)
+                async with self.lock(group_id):
+                    await self.store.compact(group_id)
+            self.store.reindex_finish()
+            logger.info('语录索引重建完成')
+        except Exception as e:
+            logger.error(f'语录索引重建失败: {e}')
+
+    # 等正在进行的刷写与重建结束, 再把所有群落盘
+    async def aclose(self):
+        if self._task is not None:
+            self._stopping = True
+            if self._reindex_task is not None:
+                await self._reindex_task
+            self._wakeup.set()
+            await self._task
+        await self.store.aclose()
@@ -0,0 +1,303 @@
+import os
+import json
+import random
+import sqlite3
+from nonebot.log import logger
+from .task import query_words, rank
+from .analyzer import ANALYZER_VERSION, DEFAULT_STOPWORDS, normalize, normalize_tags, filter_words, stopword_list
+from .index import name_keys
+from . import boolquery
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS docs (
+    group_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (group_id, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS terms (
+    group_id TEXT NOT NULL,
+    word TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (group_id, word, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS terms_doc ON terms (group_id, name);
+CREATE TABLE IF NOT EXISTS aliases (
+    group_id TEXT NOT NULL,
+    alias TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (group_id, alias)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS aliases_doc ON aliases (group_id, name);
+CREATE TABLE IF NOT EXISTS tags (
+    group_id TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (group_id, tag, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tags_doc ON tags (group_id, name);
+CREATE TABLE IF NOT EXISTS drawn (
+    group_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (group_id, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+
+# SQLite 索引: docs 表存语录记录, terms 表为 (群, 词, 图片) 倒排表
+# 分词仍使用 jieba, 与内存索引的匹配结果保持一致; 每次变更单独提交, 无需整表重写
+class SqliteStore:
+
+    buffered = 0    # 每次变更已直接提交, 无需刷写
+
+    def __init__(self, db_path, search_topk=0):
+        self.search_topk = search_topk
+        self._reindex_pos = {}  # 群 -> 重建进度
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+        # 旧数据库补建图片名查找表
+        if self.conn.execute('SELECT 1 FROM aliases LIMIT 1').fetchone() is None:
+            with self.conn:
+                for group_id, name in self.conn.execute('SELECT group_id, name FROM docs').fetchall():
+                    self._add_aliases(group_id, name)
+
+
+    def _add_aliases(self, group_id, name):
+        keys = name_keys(name)
+        # 完整文件名优先, 派生的键不覆盖已有的
+        self.conn.execute('INSERT OR REPLACE INTO aliases VALUES (?, ?, ?)', (group_id, keys[0], name))
+        self.conn.executemany('INSERT OR IGNORE INTO aliases VALUES (?, ?, ?)',
+                              ((group_id, key, name) for key in keys[1:]))
+
+    def is_empty(self):
+        return self.conn.execute('SELECT 1 FROM docs LIMIT 1').fetchone() is None
+
+    # 从内存索引一次性导入, 标签写入标签表
+    # 由旧json表载入的群标签仍混在分词中, 按原样导入 terms 表
+    def import_index(self, index):
+        with self.conn:
+            for group_id, group in index.items():
+                names = group.names
+                self.conn.executemany('INSERT OR IGNORE INTO docs VALUES (?, ?)',
+                                      ((group_id, name) for name in group.record_names()))
+                for table, postings in (('terms', group.postings), ('tags', group.tags)):
+                    for word, arr in postings.items():
+                        self.conn.executemany('INSERT OR IGNORE INTO docs VALUES (?, ?)',
+                                              ((group_id, names[i]) for i in arr))
+                        self.conn.executemany(f'INSERT OR IGNORE INTO {table} VALUES (?, ?, ?)',
+                                              ((group_id, word, names[i]) for i in arr))
+            self.conn.execute('DELETE FROM aliases')
+            for group_id, name in self.conn.execute('SELECT group_id, name FROM docs').fetchall():
+                self._add_aliases(group_id, name)
+
+    def has_group(self, group_id):
+        return self.conn.execute('SELECT 1 FROM docs WHERE group_id = ? LIMIT 1', (group_id,)).fetchone() is not None
+
+    # 按适配器给出的图片名找到库中的图片名
+    def _resolve(self, img_name, group_id):
+        img_name = os.path.basename(img_name).lower()
+        for key in (img_name, os.path.splitext(img_name)[0]):
+            row = self.conn.execute('SELECT name FROM aliases WHERE group_id = ? AND alias = ?',
+                                    (group_id, key)).fetchone()
+            if row is not None:
+                return row[0]
+        return None
+
+    # 不建字二元组索引, text 不使用
+    def offer_words(self, group_id, img_file, cut_words, text=None):
+        with self.conn:
+            if self.conn.execute('INSERT OR IGNORE INTO docs VALUES (?, ?)', (group_id, img_file)).rowcount:
+                self._add_aliases(group_id, img_file)
+            self.conn.execute('DELETE FROM terms WHERE group_id = ? AND name = ?', (group_id, img_file))
+            self.conn.executemany('INSERT OR IGNORE INTO terms VALUES (?, ?, ?)',
+                                  ((group_id, word, img_file) for word in cut_words))
+
+    # 组合查询需要位图与原文二元组, SQLite 引擎不支持, 返回 status 3 由调用方提示, 不退化为关键词匹配
+    def query(self, sentence, group_id):
+        if boolquery.is_boolean(boolquery.tokenize(sentence)):
+            return {'status': 3}
+        cut_words = list(set(query_words(sentence)))
+        if not self.has_group(group_id):
+            return {'status': -1}
+        if not cut_words:
+            return {'status': 2}
+        if sentence.startswith('#'):
+            # 先查标签表, 没有时再查分词(旧版本的标签混在分词中)
+            for table, column in (('tags', 'tag'), ('terms', 'word')):
+                row = self.conn.execute(f'SELECT name FROM {table} WHERE group_id = ? AND {column} = ? ORDER BY random() LIMIT 1',
+                                        (group_id, cut_words[0])).fetchone()
+                if row is not None:
+                    return {'status': 1, 'msg': row[0]}
+            return {'status': 2}
+        row = self.conn.execute(
+            'SELECT name FROM (SELECT name FROM terms WHERE group_id = ? AND word IN ({}) '
+            'GROUP BY name HAVING COUNT(*) = ?) ORDER BY random() LIMIT 1'.format(','.join('?' * len(cut_words))),
+            (group_id, *cut_words, len(cut_words))).fetchone()
+        if row is not None:
+            return {'status': 1, 'msg': row[0]}
+        if not self.search_topk:
+            return {'status': 2}
+        ranked = self._rank(group_id, cut_words)
+        if not ranked:
+            return {'status': 2}
+        return {'status': 1, 'msg': random.choice(ranked)}
+
+    # 模糊匹配, 与内存索引使用相同的BM25打分
+    def _rank(self, group_id, cut_words):
+        placeholders = ','.join('?' * len(cut_words))
+        posting_lists = {}
+        for word, name in self.conn.execute(
+                'SELECT word, name FROM terms WHERE group_id = ? AND word IN ({})'.format(placeholders),
+                (group_id, *cut_words)):
+            posting_lists.setdefault(word, []).append(name)
+        if not posting_lists:
+            return []
+        doc_lens = dict(self.conn.execute(
+            'SELECT name, COUNT(*) FROM terms WHERE group_id = ? AND name IN '
+            '(SELECT name FROM terms WHERE group_id = ? AND word IN ({})) GROUP BY name'.format(placeholders),
+            (group_id, group_id, *cut_words)))
+        n, total_len = self.conn.execute('SELECT COUNT(DISTINCT name), COUNT(*) FROM terms WHERE group_id = ?',
+                                         (group_id,)).fetchone()
+        return rank(posting_lists.values(), doc_lens.__getitem__, n, total_len, self.search_topk)
+
+    # 一轮内不重复: drawn 表记录本轮已发送的语录, 全部发过后清空该范围重新开始
+    def random_pick(self, group_id, author=None):
+        prefix = '' if author is None else f'{author}_'
+        with self.conn:
+            for _ in range(2):
+                row = self.conn.execute(
+                    'SELECT name FROM docs WHERE group_id = ? AND substr(name, 1, ?) = ? '
+                    'AND name NOT IN (SELECT name FROM drawn WHERE group_id = ?) ORDER BY random() LIMIT 1',
+                    (group_id, len(prefix), prefix, group_id)).fetchone()
+                if row is not None:
+                    self.conn.execute('INSERT OR IGNORE INTO drawn VALUES (?, ?)', (group_id, row[0]))
+                    return row[0]
+                self.conn.execute('DELETE FROM drawn WHERE group_id = ? AND substr(name, 1, ?) = ?',
+                                  (group_id, len(prefix), prefix))
+        return None
+
+    def author_count(self, group_id, author):
+        prefix = f'{author}_'
+        return self.conn.execute('SELECT COUNT(*) FROM docs WHERE group_id = ? AND substr(name, 1, ?) = ?',
+                                 (group_id, len(prefix), prefix)).fetchone()[0]
+
+    def delete(self, img_name, group_id):
+        path = self._resolve(img_name, group_id)
+        if path is None:
+            return False
+        with self.conn:
+            self.conn.execute('DELETE FROM terms WHERE group_id = ? AND name = ?', (group_id, path))
+            self.conn.execute('DELETE FROM docs WHERE group_id = ? AND name = ?', (group_id, path))
+            self.conn.execute('DELETE FROM aliases WHERE group_id = ? AND name = ?', (group_id, path))
+            self.conn.execute('DELETE FROM drawn WHERE group_id = ? AND name = ?', (group_id, path))
+            self.conn.execute('DELETE FROM tags WHERE group_id = ? AND name = ?', (group_id, path))
+        return True
+
+    def find_tags(self, img_name, group_id):
+        path = self._resolve(img_name, group_id)
+        if path is None:
+            return None
+        rows = self.conn.execute('SELECT tag FROM tags WHERE group_id = ? AND name = ?', (group_id, path))
+        return {row[0] for row in rows}
+
+    def tag_counts(self, group_id, limit=20):
+        return self.conn.execute('SELECT tag, COUNT(*) AS n FROM tags WHERE group_id = ? GROUP BY tag ORDER BY n DESC LIMIT ?',
+                                 (group_id, limit)).fetchall()
+
+    def add_tags(self, tags, img_name, group_id):
+        path = self._resolve(img_name, group_id)
+        if path is None:
+            return None
+        tags = normalize_tags(tags)
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO tags VALUES (?, ?, ?)',
+                                  ((group_id, tag, path) for tag in tags))
+        return path
+
+    def del_tags(self, tags, img_name, group_id):
+        path = self._resolve(img_name, group_id)
+        if path is None:
+            return None
+        tags = normalize_tags(tags)
+        with self.conn:
+            self.conn.executemany('DELETE FROM tags WHERE group_id = ? AND tag = ? AND name = ?',
+                                  ((group_id, tag, path) for tag in tags))
+            self.conn.executemany('DELETE FROM terms WHERE group_id = ? AND word = ? AND name = ?',
+                                  ((group_id, tag, path) for tag in tags))
+        return path
+
+    # 查询由 SQLite 完成, 不做结果缓存
+    def cache_info(self):
+        return None
+
+    # 建索引时的停用词, 没有记录的旧数据库是按默认停用词建立的
+    def _stopwords(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'stopwords'").fetchone()
+        return json.loads(row[0]) if row is not None else sorted(normalize(word) for word in DEFAULT_STOPWORDS)
+
+    # 分析规则版本记录在 user_version 中, 停用词记录在 meta 表中, 任一与当前不同时逐群重建
+    def reindex_pending(self):
+        if (self.conn.execute('PRAGMA user_version').fetchone()[0] >= ANALYZER_VERSION
+                and self._stopwords() == stopword_list()):
+            return []
+        return [row[0] for row in self.conn.execute('SELECT DISTINCT group_id FROM docs')]
+
+    # 按词转换, 每次最多处理 batch 个不同的词/标签, 返回该群是否已完成
+    # 进度为 (表序号, 上一个处理的词), 只在内存中; 转换可重复执行, 重启后从头开始也不影响结果
+    def reindex_step(self, group_id, batch):
+        tables = (('terms', 'word', lambda w: filter_words([normalize(w)])),
+                  ('tags', 'tag', lambda t: normalize_tags([t])))
+        step, last = self._reindex_pos.get(group_id, (0, ''))
+        table, column, convert = tables[step]
+        words = [row[0] for row in self.conn.execute(
+            f'SELECT DISTINCT {column} FROM {table} WHERE group_id = ? AND {column} > ? ORDER BY {column} LIMIT ?',
+            (group_id, last, batch))]
+        with self.conn:
+            for word in words:
+                new = convert(word)
+                if new == [word]:
+                    continue
+                if new:
+                    self.conn.execute(f'INSERT OR IGNORE INTO {table} SELECT group_id, ?, name FROM {table} '
+                                      f'WHERE group_id = ? AND {column} = ?', (new[0], group_id, word))
+                self.conn.execute(f'DELETE FROM {table} WHERE group_id = ? AND {column} = ?', (group_id, word))
+        if len(words) == batch:
+            self._reindex_pos[group_id] = (step, words[-1])
+            return False
+        if step + 1 < len(tables):
+            self._reindex_pos[group_id] = (step + 1, '')
+            return False
+        self._reindex_pos.pop(group_id, None)
+        return True
+
+    # 不保存原文, 不再是停用词的词无法补回旧语录的索引, 只对新上传的生效
+    def reindex_finish(self):
+        stopwords = stopword_list()
+        restored = set(self._stopwords()) - set(stopwords)
+        if restored:
+            logger.warning(f'SQLite引擎无法为已有语录补建以下原停用词的索引: {" ".join(sorted(restored))}')
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('stopwords', ?)",
+                              (json.dumps(stopwords, ensure_ascii=False),))
+        self.conn.execute(f'PRAGMA user_version = {ANALYZER_VERSION}')
+
+    def dirty(self):
+        return {}
+
+    # 每次变更已直接提交, 没有日志需要写入或压缩
+    async def write_journal(self, group_id):
+        pass
+
+    async def compact(self, group_id):
+        pass
+
+    # 连接只能在创建它的线程中使用, 直接在事件循环上关闭
+    async def aclose(self):
+        self.conn.close()
@@ -0,0 +1,268 @@
+import os
+import sys
+import struct
+import asyncio
+import ujson as json
+from array import array
+from nonebot.log import logger
+from .task import offer_words, delete, addTag, delTag
+from .index import GroupIndex
+from .analyzer import normalize, filter_words
+
+SNAPSHOT_MAGIC = b'QIDX'
+SNAPSHOT_VERSION = 1
+
+
+# 原子写入: 先写临时文件再替换, 避免写到一半崩溃损坏快照
+def atomic_write(path, data):
+    tmp_path = path + '.tmp'
+    if isinstance(data, bytes):
+        f = open(tmp_path, 'wb')
+    else:
+        f = open(tmp_path, 'w', encoding='UTF-8')
+    with f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# 索引快照
+# 头部: 魔数 + 版本 + json头长度, json头中是各群的文件名/词表与数组长度, 之后依次是各数组的原始字节
+def encode_snapshot(index):
+    metas = []
+    blobs = []
+    for group_id, group in index.items():
+        meta, arrays = group.encode()
+        meta['id'] = group_id
+        meta['lens'] = [len(arr) for arr in arrays]
+        metas.append(meta)
+        blobs.extend(arr.tobytes() for arr in arrays)
+    header = json.dumps({'byteorder': sys.byteorder, 'groups': metas}, ensure_ascii=False).encode('UTF-8')
+    return b''.join([SNAPSHOT_MAGIC, struct.pack('<II', SNAPSHOT_VERSION, len(header)), header, *blobs])
+
+
+def decode_snapshot(data):
+    if data[:4] != SNAPSHOT_MAGIC:
+        raise ValueError('不是语录索引快照')
+    version, header_len = struct.unpack_from('<II', data, 4)
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f'不支持的快照版本: {version}')
+    header = json.loads(data[12:12 + header_len].decode('UTF-8'))
+    view = memoryview(data)
+    pos = 12 + header_len
+    index = {}
+    for meta in header['groups']:
+        arrays = []
+        for length in meta['lens']:
+            arr = array('I')
+            size = length * arr.itemsize
+            arr.frombytes(view[pos:pos + size])
+            if header['byteorder'] != sys.byteorder:
+                arr.byteswap()
+            arrays.append(arr)
+            pos += size
+        index[meta['id']] = GroupIndex.decode(meta, arrays)
+    return index
+
+
+def read_snapshot(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return decode_snapshot(f.read())
+
+
+# 崩溃时写了一半的最后一行没有换行符, 之后追加前先补上, 避免新的日志行接在坏行后面一起被跳过
+def _tail_newline(path):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return '' if f.read(1) == b'\n' else '\n'
+    except OSError:
+        # 文件不存在或为空
+        return ''
+
+
+# 索引变更日志 (只追加)
+# 变更先进入内存缓冲, 由后台刷写任务在线程中批量追加到文件, 事件循环上不做磁盘IO
+# 压缩: 把当前状态写成快照, 然后丢弃旧日志
+class Journal:
+
+    def __init__(self, path):
+        self.path = path
+        self.old_path = path + '.old'
+        self.count = 0      # 快照之后的变更数
+        self._buffer = []   # 尚未写入文件的日志行
+        self.stale = False  # 有不写日志的变化(随机抽取进度), 关闭时需要重写快照
+        self._busy = False
+
+    @property
+    def buffered(self):
+        return len(self._buffer)
+
+    def append(self, op, group_id, img, **kwargs):
+        entry = {'op': op, 'group': group_id, 'img': img, **kwargs}
+        self._buffer.append(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.count += 1
+
+    def _write(self, lines):
+        if not lines:
+            return
+        prefix = _tail_newline(self.path)
+        with open(self.path, 'a', encoding='UTF-8') as f:
+            f.write(prefix)
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # 把当前日志换成 .old, 之后的写入进入新日志
+    # 快照写完之前崩溃的话, 启动时会重放 .old 与新日志
+    def _rotate(self):
+        if not os.path.exists(self.path):
+            return
+        if os.path.exists(self.old_path):
+            # 上一次压缩没有完成, 把残留日志合并进来
+            prefix = _tail_newline(self.old_path)
+            with open(self.old_path, 'a', encoding='UTF-8') as fo, open(self.path, 'r', encoding='UTF-8') as fr:
+                fo.write(prefix + fr.read())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.old_path)
+
+    def _finish_compact(self, snapshot_path, data):
+        atomic_write(snapshot_path, data)
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+
+    def _compact(self, lines, index, snapshot_path):
+        self._write(lines)
+        self._rotate()
+        self._finish_compact(snapshot_path, encode_snapshot(index))
+
+    async def flush(self):
+        if self._busy or not self._buffer:
+            return
+        self._busy = True
+        lines, self._buffer = self._buffer, []
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, lines)
+        except Exception as e:
+            self._buffer[:0] = lines
+            logger.error(f'语录索引日志写入失败: {e}')
+        finally:
+            self._busy = False
+
+    # 序列化与写文件都在线程中进行, 调用方需保证期间索引不被修改
+    async def compact(self, index, snapshot_path):
+        if self._busy or (self.count == 0 and not self.stale):
+            return
+        self._busy = True
+        lines, self._buffer = self._buffer, []
+        count, self.count = self.count, 0
+        self.stale = False
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._compact, lines, index, snapshot_path)
+            logger.info('语录索引日志已压缩为快照')
+        except Exception as e:
+            self._buffer[:0] = lines
+            self.count += count
+            self.stale = True
+            logger.error(f'语录索引日志压缩失败: {e}')
+        finally:
+            self._busy = False
+
+    # 关闭时把剩余日志写入并压缩
+    def close(self, index, snapshot_path):
+        lines, self._buffer = self._buffer, []
+        if self.count > 0 or self.stale:
+            self._write(lines)
+            self._rotate()
+            self._finish_compact(snapshot_path, encode_snapshot(index))
+            self.count = 0
+            self.stale = False
+        else:
+            self._write(lines)
+
+
+def _apply(entry, index):
+    op = entry['op']
+    group_id = entry['group']
+    img = entry['img']
+    if op == 'offer':
+        # 旧版本写下的日志中词未经规范化, 重放时统一处理 (对新日志无影响)
+        words = filter_words(normalize(word) for word in entry['words'])
+        offer_words(group_id, img, words, index, entry.get('text'))
+    elif op == 'delete':
+        delete(img, group_id, index)
+    elif op == 'addtag' and group_id in index:
+        addTag(entry['tags'], img, group_id, index)
+    elif op == 'deltag' and group_id in index:
+        delTag(entry['tags'], img, group_id, index)
+
+
+# 每个群一个分片: <group_id>.snapshot + <group_id>.journal
+def shard_paths(index_dir, group_id):
+    return os.path.join(index_dir, f'{group_id}.snapshot'), os.path.join(index_dir, f'{group_id}.journal')
+
+
+def write_shard(index_dir, group_id, group):
+    atomic_write(shard_paths(index_dir, group_id)[0], encode_snapshot({group_id: group}))
+
+
+# 所有分片写完后写入完成标记; 没有标记时分片不完整(第一次建立时中途退出), 需要重新建立
+SHARDS_DONE = 'shards.done'
+
+
+def shards_complete(index_dir):
+    return os.path.exists(os.path.join(index_dir, SHARDS_DONE))
+
+
+def mark_shards_complete(index_dir):
+    atomic_write(os.path.join(index_dir, SHARDS_DONE), '')
+
+
+# 读取所有分片并重放各自的日志, 返回索引与各群未压缩的日志条数
+# 单个分片损坏只影响该群
+def load_shards(index_dir):
+    index = {}
+    pending = {}
+    group_ids = set()
+    for file_name in os.listdir(index_dir):
+        for suffix in ('.snapshot', '.journal', '.journal.old'):
+            if file_name.endswith(suffix):
+                group_ids.add(file_name[:-len(suffix)])
+    for group_id in group_ids:
+        snapshot_path, journal_path = shard_paths(index_dir, group_id)
+        try:
+            index.update(read_snapshot(snapshot_path) or {})
+        except Exception as e:
+            # 保留损坏的快照以便手动恢复, 避免之后被新快照覆盖
+            os.replace(snapshot_path, snapshot_path + '.corrupt')
+            logger.error(f'读取群{group_id}的语录索引分片失败: {e}, 已另存为 {snapshot_path}.corrupt')
+        pending[group_id] = replay_journal(journal_path, index)
+    return index, pending
+
+
+# 启动时重放日志, 各操作可重复执行, 压缩中途崩溃导致的重复重放不影响结果
+def replay_journal(path, index):
+    applied = 0
+    for journal_path in (path + '.old', path):
+        if not os.path.exists(journal_path):
+            continue
+        with open(journal_path, 'r', encoding='UTF-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 崩溃时写了一半的行
+                    logger.warning(f'跳过损坏的日志行: {line[:50]}')
+                    continue
+                _apply(entry, index)
+                applied += 1
+    if applied:
+        logger.info(f'已重放{applied}条语录索引日志')
+    return applied
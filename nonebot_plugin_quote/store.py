@@ -0,0 +1,142 @@
+import asyncio
+from .task import offer_words, query, delete, findAlltag, addTag, delTag, tagCount
+from .storage import Journal, shard_paths
+from .cache import QueryCache
+from .analyzer import ANALYZER_VERSION, stopword_list
+
+
+# 默认的内存索引: 各群的 GroupIndex 常驻内存
+# 每个群有自己的快照和变更日志, 只压缩有变更的群
+# 加锁与后台刷写由 QuoteService 负责
+class MemoryStore:
+
+    def __init__(self, index, index_dir, pending=None, search_topk=0, cache_size=256, fuzzy_ratio=0):
+        self.index = index
+        self.index_dir = index_dir
+        self.search_topk = search_topk
+        self.fuzzy_ratio = fuzzy_ratio
+        self.cache = QueryCache(cache_size)
+        self.journals = {}
+        for group_id, count in (pending or {}).items():
+            if count > 0:
+                self._journal(group_id).count = count
+
+    def _journal(self, group_id):
+        journal = self.journals.get(group_id)
+        if journal is None:
+            journal = self.journals[group_id] = Journal(shard_paths(self.index_dir, group_id)[1])
+        return journal
+
+    def _shard(self, group_id):
+        return {group_id: self.index[group_id]} if group_id in self.index else {}
+
+    # 未写入文件的日志行数
+    @property
+    def buffered(self):
+        return sum(journal.buffered for journal in self.journals.values())
+
+    # 有变更的群 -> 快照之后的变更数
+    def dirty(self):
+        return {group_id: journal.count for group_id, journal in self.journals.items()
+                if journal.count > 0 or journal.buffered > 0}
+
+    def has_group(self, group_id):
+        return group_id in self.index and len(self.index[group_id].records) > 0
+
+    def offer_words(self, group_id, img_file, words, text=None):
+        offer_words(group_id, img_file, words, self.index, text)
+        group = self.index[group_id]
+        doc_id = group.ids[img_file]
+        self._journal(group_id).append('offer', group_id, img_file, words=list(group.terms[doc_id]),
+                                       text=group.grams.texts[doc_id])
+
+    def query(self, sentence, group_id):
+        return query(sentence, group_id, self.index, self.search_topk, self.cache, self.fuzzy_ratio)
+
+    # 随机取一条, author 为上传者qq时只在其上传的语录中选
+    # 一轮内不重复; 抽取进度(包括各上传者的)随快照保存, 不写日志
+    def random_pick(self, group_id, author=None):
+        group = self.index.get(group_id)
+        if group is None:
+            return None
+        bag = group.records if author is None else group.authors.get(author)
+        if not bag:
+            return None
+        doc_id = bag.draw()
+        self._journal(group_id).stale = True
+        return group.names[doc_id]
+
+    def author_count(self, group_id, author):
+        group = self.index.get(group_id)
+        return 0 if group is None else len(group.authors.get(author, ()))
+
+    def delete(self, img_name, group_id):
+        check = delete(img_name, group_id, self.index)
+        if check:
+            self._journal(group_id).append('delete', group_id, img_name)
+        return check
+
+    # 查询缓存的命中/未命中次数
+    def cache_info(self):
+        return self.cache.info()
+
+    def find_tags(self, img_name, group_id):
+        if group_id not in self.index:
+            return None
+        return findAlltag(img_name, self.index, group_id)
+
+    def tag_counts(self, group_id, limit=20):
+        return tagCount(group_id, self.index, limit)
+
+    def add_tags(self, tags, img_name, group_id):
+        if group_id not in self.index:
+            return None
+        path = addTag(tags, img_name, group_id, self.index)
+        if path is not None:
+            self._journal(group_id).append('addtag', group_id, path, tags=tags)
+        return path
+
+    def del_tags(self, tags, img_name, group_id):
+        if group_id not in self.index:
+            return None
+        path = delTag(tags, img_name, group_id, self.index)
+        if path is not None:
+            self._journal(group_id).append('deltag', group_id, path, tags=tags)
+        return path
+
+    # 分析规则或停用词变化后需要重建的群
+    def reindex_pending(self):
+        stopwords = stopword_list()
+        return [group_id for group_id, group in self.index.items()
+                if group.analyzer < ANALYZER_VERSION or group.stopwords != stopwords]
+
+    # 重建一批文档, 进度随快照保存, 重启后从上次的位置继续; 返回该群是否已完成
+    def reindex_step(self, group_id, batch):
+        group = self.index[group_id]
+        stopwords = stopword_list()
+        restore = set(group.stopwords) - set(stopwords)
+        group.reindex_pos = group.reindex(group.reindex_pos, batch, restore)
+        done = group.reindex_pos >= len(group.names)
+        if done:
+            group.analyzer = ANALYZER_VERSION
+            group.stopwords = stopwords
+            group.reindex_pos = 0
+        self._journal(group_id).stale = True
+        return done
+
+    def reindex_finish(self):
+        pass
+
+    async def write_journal(self, group_id):
+        await self._journal(group_id).flush()
+
+    # 调用方需持有该群的锁, 序列化期间索引不会被修改
+    async def compact(self, group_id):
+        await self._journal(group_id).compact(self._shard(group_id), shard_paths(self.index_dir, group_id)[0])
+
+    def close(self):
+        for group_id, journal in self.journals.items():
+            journal.close(self._shard(group_id), shard_paths(self.index_dir, group_id)[0])
+
+    async def aclose(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
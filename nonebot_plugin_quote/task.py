@@ -2,92 +2,141 @@ import json
 import jieba
 import os
 import random
+import math
+import heapq
 import hashlib
+import functools
 import shutil
 from nonebot.adapters.onebot.v11 import Bot, MessageSegment
+from .index import GroupIndex, intersect
+from .analyzer import normalize, normalize_tags, filter_words
+from . import boolquery
 
 
-# 向语录库添加新的图片
-def offer(group_id, img_file, content, inverted_index, forward_index):
-    # 分词
-    cut_words = cut_sentence(content)
-    # 群号是否在表中
-    if group_id not in inverted_index:
-        inverted_index[group_id] = {}
-        forward_index[group_id] = {}
-        
-    forward_index[group_id][img_file] = set(cut_words)
-    # 分词是否在群的hashmap里
-    for word in cut_words:
-        if word not in inverted_index[group_id]:
-            inverted_index[group_id][word] = [img_file]
-        else:
-            inverted_index[group_id][word].append(img_file)
-    
-    return inverted_index, forward_index
+# 短文本(群名片、常用关键词)会被反复分词, 缓存其结果
+CUT_CACHE_MAX_LEN = 32
 
-def query(sentence, group_id, inverted_index):
-    import jieba, random
-    if sentence.startswith('#'):
-        cut_words = [sentence[1:]]
-    else:
-        cut_words = jieba.lcut_for_search(sentence)
-        cut_words = list(set(cut_words))  # 去重
-    cut_words = [w.lower() if w.isascii() else w for w in cut_words]
+@functools.lru_cache(maxsize=4096)
+def _lcut_cached(sentence):
+    return tuple(jieba.lcut_for_search(sentence))
+
+def lcut_for_search(sentence):
+    if len(sentence) <= CUT_CACHE_MAX_LEN:
+        return list(_lcut_cached(sentence))
+    return jieba.lcut_for_search(sentence)
+
+# 加载jieba词典, 启动时在后台线程中调用, 避免第一次分词时在用户请求里等待
+# cache_file 为预构建词典的缓存文件, 不存在时构建一次并写入
+def warmup_jieba(cache_file=''):
+    if cache_file:
+        jieba.dt.cache_file = os.path.abspath(cache_file)
+    jieba.initialize()
+    lcut_for_search('语录')
 
-    if group_id not in inverted_index:
+
+# 按已分好的词写入索引 (由 QuoteService.offer 分词后调用, 日志重放时直接使用), text 为原文, 用于字二元组索引
+def offer_words(group_id, img_file, cut_words, index, text=None):
+    # 群号是否在表中
+    if group_id not in index:
+        index[group_id] = GroupIndex()
+    index[group_id].offer(img_file, cut_words, text)
+    return index
+
+# 查询语句分词, #开头为完整标签
+# 与建索引使用相同的分析规则
+def query_words(sentence):
+    if sentence.startswith('#'):
+        return normalize_tags([sentence[1:]])
+    return cut_sentence(sentence)
+
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 缓存键: 忽略多余空白, 按分析规则规范化
+# 布尔关键字只有大写时才是运算符, 保留其大小写, 避免 a OR b 与 a or b 共用缓存
+def normalize_query(sentence):
+    return ' '.join(token if boolquery.is_keyword(token) else normalize(token)
+                    for token in boolquery.tokenize(sentence))
+
+# topk > 0 时启用模糊匹配: 没有同时包含所有关键词的语录时, 从字二元组匹配或BM25得分的前 topk 条中随机返回
+# fuzzy_ratio 为字二元组匹配要求的最低命中比例, 为0时不使用字二元组索引
+# cache 为 QueryCache 时缓存候选池, 同一查询在索引未变化时不再分词和求交集
+def query(sentence, group_id, index, topk=0, cache=None, fuzzy_ratio=0):
+    if group_id not in index:
         return {'status': -1}
-    hash_map = inverted_index[group_id]
+    group = index[group_id]
 
-    word_sets = []
-    for word in cut_words:
-        word_key = word.lower() if word.isascii() else word
-        if word_key in hash_map:
-            word_sets.append(set(hash_map[word_key]))
-        else:
-            return {'status': 2}
+    if cache is None:
+        result_pool = search(sentence, group, topk, fuzzy_ratio)
+    else:
+        key = (group_id, normalize_query(sentence))
+        result_pool = cache.get(key, group.generation)
+        if result_pool is None:
+            result_pool = search(sentence, group, topk, fuzzy_ratio)
+            cache.put(key, group.generation, result_pool)
 
-    if not word_sets:
-        return {'status': 2}
-    result_pool = set.intersection(*word_sets)
     if not result_pool:
         return {'status': 2}
-
-    return {'status': 1, 'msg': random.choice(list(result_pool))}
-
-def _remove(arr, ele):
-    old_len = len(arr)
-    for name in arr:
-        file_name = os.path.basename(name)
-        if file_name.endswith(ele):
-            arr.remove(name)
-            break
-    
-    return len(arr) < old_len
+    return {'status': 1, 'msg': group.names[random.choice(result_pool)]}
+
+# 返回候选文档id池, 无结果时为空
+def search(sentence, group, topk=0, fuzzy_ratio=0):
+    # 含有 | - 引号 括号 等语法时按布尔查询处理
+    if boolquery.is_boolean(boolquery.tokenize(sentence)):
+        return boolquery.search(sentence, group, query_words)
+    cut_words = query_words(sentence)
+    if sentence.startswith('#'):
+        # 标签查询只查标签索引; 旧版本的标签混在分词中, 标签索引里没有时再查分词
+        if not cut_words:
+            return []
+        tag = cut_words[0]
+        return group.tags.get(tag) or group.postings.get(tag) or []
+    posting_lists = [group.postings[word] for word in cut_words if word in group.postings]
+
+    if posting_lists and len(posting_lists) == len(cut_words):
+        result_pool = intersect(posting_lists)
+        if result_pool:
+            return result_pool
+    if not topk:
+        return []
+
+    # 关键词对不上(OCR切错词、认错字)时按字二元组做子串/模糊匹配
+    if fuzzy_ratio > 0:
+        result_pool = group.grams.search(sentence, fuzzy_ratio, topk)
+        if result_pool:
+            return result_pool
+    if not posting_lists:
+        return []
+    return rank(posting_lists, lambda doc_id: len(group.terms[doc_id]), len(group.terms), group.total_len, topk)
+
+# 只为出现过关键词的语录打分, 用堆取得分最高的 topk 条
+# 每张图片的词是集合(词频恒为1), 文档长度为其词数, 文档频率为倒排表长度
+# n 为有分词的文档数, total_len 为所有文档的词数之和
+def rank(posting_lists, doc_len, n, total_len, topk):
+    avgdl = total_len / n
+    scores = {}
+    norms = {}
+    for arr in posting_lists:
+        df = len(arr)
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        for doc_id in arr:
+            norm = norms.get(doc_id)
+            if norm is None:
+                dl = doc_len(doc_id)
+                norm = norms[doc_id] = (BM25_K1 + 1) / (1 + BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl))
+            scores[doc_id] = scores.get(doc_id, 0) + idf * norm
+    return heapq.nlargest(topk, scores, key=scores.__getitem__)
 
 # 删除内容
-def delete(img_name, group_id, record, inverted_index, forward_index):
-    check = False
-    try:
-        keys = list(inverted_index[group_id].keys())
-        for key in keys:
-            check = _remove(inverted_index[group_id][key], img_name) or check
-            if len(inverted_index[group_id][key]) == 0:
-                del inverted_index[group_id][key]
-        
-        check = _remove(record[group_id], img_name) or check
-        if len(record[group_id]) == 0:
-            del record[group_id]
-
-        for key in forward_index[group_id].keys():
-            file_name = os.path.basename(key)
-            if file_name.endswith(img_name):
-                del forward_index[group_id][key]
-                break
-
-        return check, record, inverted_index, forward_index
-    except KeyError:
-        return check, record, inverted_index, forward_index
+def delete(img_name, group_id, index):
+    if group_id not in index:
+        return False
+    group = index[group_id]
+    doc_id = group.resolve(img_name)
+    if doc_id is None:
+        return False
+    return group.remove(doc_id)
 
 
 
@@ -123,70 +172,47 @@ def handle_ocr_text(texts):
 
 
 def cut_sentence(sentence):
-    cut_words = jieba.lcut_for_search(sentence)
-    cut_words = list(set(cut_words))
-    remove_set = set(['.',',','!','?',':',';','。','，','！','？','：','；','%','$','\n',' ','[',']'])
-    new_words = [word for word in cut_words if word not in remove_set]
-
-    return new_words
+    # 按空白分段分词, 与整句分词结果相同, 群名片等短段可以命中分词缓存
+    cut_words = []
+    for part in normalize(sentence).split():
+        cut_words.extend(lcut_for_search(part))
+    return filter_words(cut_words)
 
 
-# 倒排索引 转 正向索引
-def inverted2forward(inverted_index):
-    forward_index = {}
-    for qq_group in inverted_index.keys():
-        forward_index[qq_group] = {}
-        for word, imgs in inverted_index[qq_group].items():
-            for img in imgs:
-                forward_index[qq_group].setdefault(img, set()).add(word)
-    return forward_index
+# 输出所有tag
+def findAlltag(img_name, index, group_id):
+    group = index[group_id]
+    doc_id = group.resolve(img_name)
+    if doc_id is not None:
+        return group.doc_tags.get(doc_id, set())
 
 
-# 输出所有tag
-def findAlltag(img_name, forward_index, group_id):
-    for key, value in forward_index[group_id].items():
-        file_name = os.path.basename(key)
-        if file_name.endswith(img_name):
-            return value
+# 标签使用次数排行
+def tagCount(group_id, index, limit=20):
+    if group_id not in index:
+        return []
+    return index[group_id].tag_counts(limit)
 
 
 # 添加tag
-def addTag(tags, img_name, group_id, forward_index, inverted_index):
+def addTag(tags, img_name, group_id, index):
     # 是否存在
-    path = None
-    for key in forward_index[group_id].keys():
-        file_name = os.path.basename(key)
-        if file_name.endswith(img_name):
-            path = key
-            for tag in tags:
-                forward_index[group_id][key].add(tag)
-            break
-    if path is None:
-        return None, forward_index, inverted_index
-    for tag in tags:
-        inverted_index[group_id].setdefault(tag, []).append(path)
-    return path, forward_index, inverted_index
+    group = index[group_id]
+    doc_id = group.resolve(img_name)
+    if doc_id is None:
+        return None
+    group.add_tags(doc_id, normalize_tags(tags))
+    return group.names[doc_id]
 
 
 # 删除tag
-def delTag(tags, img_name, group_id, forward_index, inverted_index):
-    path = None
-    for key in forward_index[group_id].keys():
-        file_name = os.path.basename(key)
-        if file_name.endswith(img_name):
-            path = key
-            for tag in tags:
-                forward_index[group_id][key].discard(tag)
-            break
-    if path is None:
-        return None, forward_index, inverted_index
-    keys = list(inverted_index[group_id].keys())
-    for tag in tags:
-        if tag in keys and path in inverted_index[group_id][tag]:
-            inverted_index[group_id][tag].remove(path)
-            if len(inverted_index[group_id][tag]) == 0:
-                del inverted_index[group_id][tag]
-    return path, forward_index, inverted_index
+def delTag(tags, img_name, group_id, index):
+    group = index[group_id]
+    doc_id = group.resolve(img_name)
+    if doc_id is None:
+        return None
+    group.del_tags(doc_id, normalize_tags(tags))
+    return group.names[doc_id]
 
 
 IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif']